@@ -0,0 +1,92 @@
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from lib.bot_params import (
+    BotAIModel,
+    BotAnswer,
+    BotImageQuality,
+    BotImageSize,
+    BotMode,
+    BotParams,
+    BotState,
+    BotTypeTranslate,
+)
+from lib.speech import SpeechLang
+
+
+# Прежняя реализация параметров: атрибуты в __dict__ и таблица типов в каждом экземпляре
+class LegacyBotParams:
+    def __init__(self, data=None):
+        self.state = BotState.START
+        self.answer = BotAnswer.TEXT
+        self.mode = BotMode.AI
+        self.model = BotAIModel.CHAT_GPT_35
+        self.type_translate = BotTypeTranslate.AUTO
+        self.lang = SpeechLang.AUTO
+        self.image_size = BotImageSize.SQUARE
+        self.image_quality = BotImageQuality.STANDARD
+        self.image_count = 1
+        self.data = {"text": "", "file_id": None, "last_time": None}
+        self.type_fields = {
+            "state": BotState,
+            "answer": BotAnswer,
+            "mode": BotMode,
+            "model": BotAIModel,
+            "type_translate": BotTypeTranslate,
+            "lang": SpeechLang,
+            "image_size": BotImageSize,
+            "image_quality": BotImageQuality,
+        }
+        if data:
+            self.init(data)
+
+    def init(self, data):
+        for key, val in data.items():
+            if not hasattr(self, key) or key in ["type_fields"] or callable(getattr(self, key)):
+                continue
+            res = self.type_fields[key].get_value(val) if key in self.type_fields else val
+            setattr(self, key, res)
+
+    def to_dict(self):
+        data = {}
+        for key in self.__dict__:
+            if key in ["type_fields"] or callable(getattr(self, key)):
+                continue
+            val = getattr(self, key)
+            data[key] = self.type_fields[key].get_key(val) if key in self.type_fields else val
+        return data
+
+
+def measure_memory(cls, count: int) -> float:
+    gc.collect()
+    tracemalloc.start()
+    items = [cls() for _ in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return size / count
+
+
+def measure_throughput(cls, count: int) -> (float, float):
+    items = [cls() for _ in range(count)]
+    started = time.perf_counter()
+    rows = [json.dumps(item.to_dict()) for item in items]
+    save_rate = count / (time.perf_counter() - started)
+    started = time.perf_counter()
+    for row in rows:
+        cls().init(json.loads(row))
+    load_rate = count / (time.perf_counter() - started)
+    return save_rate, load_rate
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f"Пользователей: {count}")
+    print(f"{'class':<18}{'bytes/user':>12}{'save/s':>12}{'load/s':>12}")
+    for cls in (LegacyBotParams, BotParams):
+        memory = measure_memory(cls, count)
+        save_rate, load_rate = measure_throughput(cls, count)
+        print(f"{cls.__name__:<18}{memory:>12.0f}{save_rate:>12.0f}{load_rate:>12.0f}")
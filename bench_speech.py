@@ -0,0 +1,17 @@
+import sys
+
+from lib.speech import Speech, benchmark_codecs
+
+
+VARIANTS = [("wav", None), ("mp3", "64k"), ("ogg", "16k"), ("ogg", "24k"), ("ogg", "32k"), ("ogg", "64k")]
+
+
+if __name__ == "__main__":
+    voice = sys.argv[1] if len(sys.argv) > 1 else "marina"
+    text = "Привет! Это проверка скорости кодирования голосового ответа. " * 5
+    segment = Speech(voice, "ru-RU").synthesize_segment(text)
+    print(f"Голос: {voice}, длительность: {len(segment) / 1000:.1f} с")
+    print(f"{'format':<8}{'bitrate':<10}{'bytes':>10}{'ratio':>8}{'encode_ms':>12}")
+    for res in benchmark_codecs(segment, VARIANTS):
+        bitrate = res["bitrate"] or "-"
+        print(f"{res['format']:<8}{bitrate:<10}{res['bytes']:>10}{res['ratio']:>8.1f}{res['encode_ms']:>12.1f}")
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, AsyncIterator, Coroutine, Iterator, Optional
+
+import aiohttp
+from telebot import TeleBot, apihelper, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from lib.config import Config
+from lib.http import RETRY_STATUSES
+
+
+logger = logging.getLogger(__name__)
+
+
+# Общий цикл событий в отдельном потоке для асинхронных клиентов:
+# Telegram, OpenAI и HTTP-запросы мультиплексируются в одном потоке
+class AsyncLoop:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._thread = threading.Thread(target=self._run_forever, name="aio-loop", daemon=True)
+        self._thread.start()
+
+    def _run_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("AsyncLoop.run() cannot be called from the event loop thread")
+        if self.loop.is_closed() or not self._thread.is_alive():
+            raise RuntimeError("AsyncLoop is stopped")
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return future.result(timeout)
+
+    def iterate(self, async_iterator: AsyncIterator) -> Iterator:
+        while True:
+            try:
+                yield self.run(async_iterator.__anext__())
+            except StopAsyncIteration:
+                return
+
+    async def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    # Те же таймауты и повторы, что у синхронной сессии из create_session: таймаут соединения и чтения,
+    # повтор с растущей задержкой при ошибке соединения и ответах 429/5xx, задержка из Retry-After
+    async def post_json(
+        self,
+        url: str,
+        headers: dict,
+        data: dict,
+        timeout: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
+        retries: int = 0,
+        backoff: float = 0.5,
+    ) -> Optional[dict]:
+        session = await self.session()
+        client_timeout = aiohttp.ClientTimeout(connect=connect_timeout, sock_read=timeout)
+        for attempt in range(retries + 1):
+            delay = backoff * 2**attempt
+            try:
+                async with session.post(url, headers=headers, json=data, timeout=client_timeout) as response:
+                    if response.status == 200:
+                        return await response.json()
+                    if response.status not in RETRY_STATUSES or attempt == retries:
+                        return None
+                    retry_after = response.headers.get("Retry-After", "")
+                    if retry_after.isdigit():
+                        delay = int(retry_after)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+            await asyncio.sleep(delay)
+        return None
+
+    async def get_bytes(self, url: str, timeout: Optional[float] = None, max_bytes: Optional[int] = None) -> bytes:
+        session = await self.session()
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        async with session.get(url, timeout=client_timeout) as response:
+            response.raise_for_status()
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data += chunk
+                if max_bytes and len(data) > max_bytes:
+                    raise ValueError(f"Download exceeds {max_bytes} bytes")
+            return bytes(data)
+
+    def stop(self, timeout: float = 5.0):
+        if not self._thread.is_alive():
+            return
+        try:
+            if self._session is not None:
+                self.run(self._session.close(), timeout)
+        except Exception as ex:
+            logger.warning("Async session close error: %s", ex)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+
+def _bridge_method(name: str):
+    def method(self, *args, **kwargs):
+        try:
+            return self.aio.run(getattr(self.async_bot, name)(*args, **kwargs))
+        except asyncio_helper.ApiTelegramException as ex:
+            # Ошибки API приводятся к исключению синхронного TeleBot, которое перехватывают обработчики
+            raise apihelper.ApiTelegramException(ex.function_name, ex.result, ex.result_json) from ex
+
+    method.__name__ = name
+    return method
+
+
+# Синхронный фасад над AsyncTeleBot: обработчики регистрируются и вызываются в потоках,
+# как у обычного TeleBot, а запросы к Telegram выполняются в общем цикле событий,
+# вызывающий поток ждёт ответа
+class AsyncTeleBotBridge(TeleBot):
+    bridged_methods = (
+        "send_message",
+        "send_photo",
+        "send_voice",
+        "send_media_group",
+        "edit_message_text",
+        "delete_message",
+        "get_file",
+        "download_file",
+        "set_my_commands",
+    )
+
+    def __init__(self, token: str, aio: AsyncLoop):
+        super().__init__(token, threaded=False)
+        self.aio = aio
+        self.async_bot = AsyncTeleBot(token)
+        self._stop_polling = threading.Event()
+
+    def infinity_polling(self, timeout: int = 20, *args, **kwargs):
+        offset = None
+        self._stop_polling.clear()
+        while not self._stop_polling.is_set():
+            try:
+                updates = self.aio.run(self.async_bot.get_updates(offset=offset, timeout=timeout))
+            except Exception as ex:
+                logger.error("Async polling error: %s", ex)
+                time.sleep(3)
+                continue
+            if updates:
+                offset = updates[-1].update_id + 1
+                self.process_new_updates(updates)
+
+    def stop_polling(self):
+        self._stop_polling.set()
+
+
+for _name in AsyncTeleBotBridge.bridged_methods:
+    setattr(AsyncTeleBotBridge, _name, _bridge_method(_name))
+
+
+aio_loop = AsyncLoop() if Config.ASYNC_MODE else None
@@ -1,6 +1,7 @@
+import copy
 from typing import Optional
 
-from lib.enum import BaseEnum, BaseEnumTuple
+from lib.enum import BaseEnum, BaseEnumTuple, EnumMenu
 from lib.speech import SpeechLang
 
 
@@ -19,6 +20,9 @@ class BotState(BaseEnum):
     RECOGNITION = "recognition"
     RECOGNITION_STEP2 = "recognition_step2"
     RECOGNITION_STEP3 = "recognition_step3"
+    IMAGE = "image"
+    IMAGE_STEP2 = "image_step2"
+    IMAGE_STEP3 = "image_step3"
 
 
 # Формат ответа
@@ -35,11 +39,24 @@ class BotMode(BaseEnumTuple):
     TRANSLATE = ("Переводчик", "translate")
 
 
-# Используемая модель ИИ
+# Используемая модель ИИ: название, модель, бюджет токенов истории диалога
 class BotAIModel(BaseEnumTuple):
-    CHAT_GPT_35 = ("GPT-3.5 Turbo 16K", "gpt-3.5-turbo-1106")
-    CHAT_GPT_4 = ("GPT-4 Turbo 128K", "gpt-4-1106-preview")
-    DALLE3 = ("DALL-E 3", "dall-e-3")
+    CHAT_GPT_35 = ("GPT-3.5 Turbo 16K", "gpt-3.5-turbo-1106", 12000)
+    CHAT_GPT_4 = ("GPT-4 Turbo 128K", "gpt-4-1106-preview", 120000)
+    DALLE3 = ("DALL-E 3", "dall-e-3", 0)
+
+
+# Размер генерируемого изображения
+class BotImageSize(BaseEnumTuple):
+    SQUARE = ("Квадрат", "1024x1024")
+    LANDSCAPE = ("Альбомный", "1792x1024")
+    PORTRAIT = ("Портретный", "1024x1792")
+
+
+# Качество генерируемого изображения
+class BotImageQuality(BaseEnumTuple):
+    STANDARD = ("Стандартное", "standard")
+    HD = ("Высокое", "hd")
 
 
 # Настройка типа перевода
@@ -48,62 +65,85 @@ class BotTypeTranslate(BaseEnumTuple):
     MANUAL = ("Вручную", "manual")
 
 
+# Параметры пользователя. Схема полей общая для всех экземпляров: имя, перечисление и значение по умолчанию.
+# Поля хранятся в __slots__, таблицы сериализации строятся один раз в compile_schema()
 class BotParams:
+    schema = (
+        ("state", BotState, BotState.START),
+        ("answer", BotAnswer, BotAnswer.TEXT),
+        ("mode", BotMode, BotMode.AI),
+        ("model", BotAIModel, BotAIModel.CHAT_GPT_35),
+        ("type_translate", BotTypeTranslate, BotTypeTranslate.AUTO),
+        ("lang", SpeechLang, SpeechLang.AUTO),
+        ("image_size", BotImageSize, BotImageSize.SQUARE),
+        ("image_quality", BotImageQuality, BotImageQuality.STANDARD),
+        ("image_count", None, 1),
+        ("data", None, None),
+    )
+    __slots__ = tuple(name for name, _, _ in schema)
+
     def __init__(self, data: Optional[dict] = None):
-        self.state = BotState.START
-        self.answer = BotAnswer.TEXT
-        self.mode = BotMode.AI
-        self.model = BotAIModel.CHAT_GPT_35
-        self.type_translate = BotTypeTranslate.AUTO
-        self.lang = SpeechLang.AUTO
-        self.data = {}
+        for slot, default in self._defaults:
+            setattr(self, slot, default)
         self.reset_data()
         if data:
             self.init(data)
-        self.type_fields = {
-            "state": BotState,
-            "answer": BotAnswer,
-            "mode": BotMode,
-            "model": BotAIModel,
-            "type_translate": BotTypeTranslate,
-            "lang": SpeechLang,
-        }
+
+    def __deepcopy__(self, memo):
+        new_obj = BotParams.__new__(BotParams)
+        for slot in self.__slots__:
+            setattr(new_obj, slot, getattr(self, slot))
+        new_obj.data = copy.deepcopy(self.data, memo)
+        memo[id(self)] = new_obj
+        return new_obj
+
+    # Перечисления сохраняются именами значений
+    @classmethod
+    def compile_schema(cls):
+        cls._encoders = tuple((name, enum_cls.get_key if enum_cls else None) for name, enum_cls, _ in cls.schema)
+        cls._decoders = {name: enum_cls.get_value if enum_cls else None for name, enum_cls, _ in cls.schema}
+        cls._defaults = tuple((name, default) for name, _, default in cls.schema)
 
     def init(self, data: dict):
-        missing_fields = ["type_fields"]
+        decoders = self._decoders
         for key, val in data.items():
-            if not hasattr(self, key) or key in missing_fields or callable(getattr(self, key)):
+            if key not in decoders:
                 continue
-            res = self.type_fields[key].get_value(val) if key in self.type_fields else val
-            setattr(self, key, res)
+            decode = decoders[key]
+            if decode is not None:
+                val = decode(val)
+                if val is None:
+                    continue
+            setattr(self, key, val)
 
     def to_dict(self) -> dict:
         data = {}
-        for key in self.__dict__:
-            if key in ["type_fields"] or callable(getattr(self, key)):
-                continue
-            val = getattr(self, key)
-            data[key] = self.type_fields[key].get_key(val) if key in self.type_fields else val
+        for name, encode in self._encoders:
+            val = getattr(self, name)
+            data[name] = val if encode is None else encode(val)
         return data
 
+    def get_image_options(self) -> dict:
+        return {"size": self.image_size[1], "quality": self.image_quality[1], "count": self.image_count}
+
     def reset_data(self):
         self.data = {"text": "", "file_id": None, "last_time": None}
 
 
+BotParams.compile_schema()
+
+
 def get_class_values(cls):
-    class_values = [getattr(cls, attr) for attr in vars(cls) if not attr.startswith("__")]
-    return class_values
+    return list(cls.get_values())
 
 
-def get_class_dict(cls, idx=0, capitalize=True):
-    func_str = lambda s: s.strip().capitalize() if capitalize else s.strip()
-    values = get_class_values(cls)
-    if values and isinstance(values[0], str):
-        merged_dict = {func_str(item): item for item in values}
-    else:
-        merged_dict = {item[idx]: item for item in values}
-    return merged_dict
+def get_class_dict(cls, idx=0, capitalize=True) -> EnumMenu:
+    return cls.get_menu(idx, capitalize)
 
 
 def is_value_in_class_values(value, cls):
-    return value in get_class_values(cls)
+    return cls.has_value(value)
+
+
+def get_model_budgets() -> dict:
+    return {item[1]: item[2] for item in get_class_values(BotAIModel)}
@@ -0,0 +1,241 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Hashable, Optional, Union
+
+
+# Статистика в виде «ключ: значение» по строкам для вывода администратору
+class StatsMixin(ABC):
+    @abstractmethod
+    def get_stats(self) -> dict:
+        pass
+
+    def to_str(self) -> str:
+        stats = self.get_stats()
+        return "\n".join(f"{key}: {round(val, 3) if isinstance(val, float) else val}" for key, val in stats.items())
+
+
+# Статистика кэша: размер из _size_stats(), попадания и промахи
+class CacheStatsMixin(StatsMixin):
+    hits = 0
+    misses = 0
+
+    def _size_stats(self) -> dict:
+        return {}
+
+    def get_stats(self) -> dict:
+        hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {**self._size_stats(), "hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+
+
+# Потокобезопасный LRU-кэш с необязательным временем жизни записей
+class LRUCache(CacheStatsMixin):
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item is not None else default
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def _size_stats(self) -> dict:
+        return {"size": len(self._data)}
+
+
+# Постоянный кэш «ключ-значение» в SQLite с вытеснением давно не используемых записей
+class SQLiteCache(CacheStatsMixin):
+    def __init__(
+        self, file_path: str, table: str = "cache", maxsize: Optional[int] = None, ttl: Optional[float] = None
+    ):
+        self.table = table
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._sets = 0
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB, created REAL, used REAL)"
+            )
+            self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_used ON {table} (used)")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        now = time.time()
+        with self._lock, self.connection:
+            row = self.connection.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is not None and (self.ttl is None or row[1] + self.ttl > now):
+                self.connection.execute(f"UPDATE {self.table} SET used = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return row[0]
+            if row is not None:
+                self.connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self.misses += 1
+            return default
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        with self._lock, self.connection:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created, used) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._sets += 1
+            # Проверка размера не на каждую запись, чтобы не считать строки постоянно
+            if self.maxsize and self._sets % 100 == 0:
+                self._evict()
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        with self._lock, self.connection:
+            row = self.connection.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            self.connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        return row[0] if row is not None else default
+
+    def _evict(self) -> None:
+        count = self.connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        if count > self.maxsize:
+            self.connection.execute(
+                f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY used LIMIT ?)",
+                (count - self.maxsize,),
+            )
+
+    def _size_stats(self) -> dict:
+        return {"size": len(self)}
+
+
+# Кэш файлов на диске с ограничением общего размера и вытеснением самых старых по времени доступа
+class FileCache(CacheStatsMixin):
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def set(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        with self._lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self._size += len(data) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        entries = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith(".tmp")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        # Освобождаем с запасом, чтобы не запускать вытеснение на каждую запись
+        target = self.max_bytes * 0.9
+        for entry in entries:
+            if self._size <= target:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._size -= size
+
+    def _size_stats(self) -> dict:
+        return {"bytes": self._size}
+
+
+# Двухуровневый кэш: LRU в памяти и необязательный постоянный кэш на диске.
+# Найденное на диске поднимается в память, запись идёт в оба уровня
+class TieredCache(CacheStatsMixin):
+    def __init__(self, memory: LRUCache, disk: Optional[Union[SQLiteCache, FileCache]] = None):
+        self.memory = memory
+        self.disk = disk
+
+    @property
+    def hits(self) -> int:
+        return self.memory.hits + (self.disk.hits if self.disk else 0)
+
+    @property
+    def misses(self) -> int:
+        return self.disk.misses if self.disk else self.memory.misses
+
+    def get(self, key: str) -> Any:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def _size_stats(self) -> dict:
+        stats = self.memory._size_stats()
+        if self.disk is not None:
+            stats.update({f"disk_{key}": val for key, val in self.disk._size_stats().items()})
+        return stats
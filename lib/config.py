@@ -7,7 +7,54 @@ class Config:
     API_KEY_YANDEX_TTS = None
     API_KEY_TELEGRAM_BOT = None
     OPENAI_MODEL = "gpt-3.5-turbo-1106"
+    OPENAI_STREAM = True
+    OPENAI_TIMEOUT = 120
+    OPENAI_RETRIES = 2
+    STREAM_EDIT_INTERVAL = 1.0
+    HISTORY_TOKEN_BUDGETS = {}
+    HISTORY_SUMMARIZE = False
+    HISTORY_LOG_DIR = "history"
+    HISTORY_LOG_COMPRESSION = "zlib"
+    HISTORY_LOAD_MESSAGES = 0
+    TRANSLATE_POOL_SIZE = 10
+    TRANSLATE_RETRIES = 3
+    TRANSLATE_CONNECT_TIMEOUT = 3.05
+    TRANSLATE_TIMEOUT = 10
+    DETECT_CACHE_SIZE = 4096
+    DETECT_CACHE_TTL = 86400
+    TRANSLATE_BATCH_CHARS = 10000
+    TRANSLATE_CACHE_SIZE = 2048
+    TRANSLATE_CACHE_FILE = "cache.db"
+    TRANSLATE_CACHE_DISK_SIZE = 100000
+    SPEECH_FORMAT = "ogg"
+    SPEECH_BITRATE = "32k"
+    SPEECH_CHUNK_SIZE = 500
+    SPEECH_WORKERS = 4
+    SPEECH_DELIVERY = "concat"
+    SPEECH_STREAM_MIN_DURATION = 30
+    SPEECH_STREAM_WINDOW = 20
+    TELEGRAM_DOWNLOAD_TIMEOUT = 60
+    SPEECH_RECOGNITION_FANOUT = False
+    AUDIO_CACHE_SIZE = 128
+    AUDIO_CACHE_DIR = "audio_cache"
+    AUDIO_CACHE_DISK_BYTES = 200 * 1024 * 1024
+    FILE_ID_CACHE_FILE = "cache.db"
+    IMAGE_DELIVERY = "url"
+    IMAGE_DOWNLOAD_POOL_SIZE = 4
+    IMAGE_DOWNLOAD_TIMEOUT = 60
+    IMAGE_MAX_BYTES = 10 * 1024 * 1024
+    TRANSCRIPTION_CACHE_FILE = "transcriptions.db"
+    TRANSCRIPTION_CACHE_SIZE = 10000
+    TRANSCRIPTION_CACHE_TTL = 30 * 24 * 3600
     ADMIN_IDS = []
+    USER_STORAGE = "users.db"
+    AUTOSAVE_INTERVAL = 60
+    USER_IDLE_TIMEOUT = 3600
+    ASYNC_MODE = False
+    DISPATCHER_WORKERS = 8
+    DISPATCHER_QUEUE_SIZE = 10
+    METRICS_PORT = 0
+    METRICS_HOST = "127.0.0.1"
 
     @classmethod
     def load_config(cls, file_path="config.yaml"):
@@ -16,9 +63,58 @@ class Config:
             cls.API_KEY_OPENAI = config_data["API_KEY_OPENAI"]
             cls.OPENAI_URL = config_data["OPENAI_URL"]
             cls.OPENAI_MODEL = config_data["OPENAI_MODEL"]
+            cls.OPENAI_STREAM = config_data.get("OPENAI_STREAM", cls.OPENAI_STREAM)
+            cls.OPENAI_TIMEOUT = config_data.get("OPENAI_TIMEOUT", cls.OPENAI_TIMEOUT)
+            cls.OPENAI_RETRIES = config_data.get("OPENAI_RETRIES", cls.OPENAI_RETRIES)
+            cls.STREAM_EDIT_INTERVAL = config_data.get("STREAM_EDIT_INTERVAL", cls.STREAM_EDIT_INTERVAL)
+            cls.HISTORY_TOKEN_BUDGETS = config_data.get("HISTORY_TOKEN_BUDGETS") or cls.HISTORY_TOKEN_BUDGETS
+            cls.HISTORY_SUMMARIZE = config_data.get("HISTORY_SUMMARIZE", cls.HISTORY_SUMMARIZE)
+            cls.HISTORY_LOG_DIR = config_data.get("HISTORY_LOG_DIR", cls.HISTORY_LOG_DIR)
+            cls.HISTORY_LOG_COMPRESSION = config_data.get("HISTORY_LOG_COMPRESSION", cls.HISTORY_LOG_COMPRESSION)
+            cls.HISTORY_LOAD_MESSAGES = config_data.get("HISTORY_LOAD_MESSAGES", cls.HISTORY_LOAD_MESSAGES)
             cls.API_KEY_YANDEX_TTS = config_data["API_KEY_YANDEX_TTS"]
+            cls.TRANSLATE_POOL_SIZE = config_data.get("TRANSLATE_POOL_SIZE", cls.TRANSLATE_POOL_SIZE)
+            cls.TRANSLATE_RETRIES = config_data.get("TRANSLATE_RETRIES", cls.TRANSLATE_RETRIES)
+            cls.TRANSLATE_CONNECT_TIMEOUT = config_data.get("TRANSLATE_CONNECT_TIMEOUT", cls.TRANSLATE_CONNECT_TIMEOUT)
+            cls.TRANSLATE_TIMEOUT = config_data.get("TRANSLATE_TIMEOUT", cls.TRANSLATE_TIMEOUT)
+            cls.DETECT_CACHE_SIZE = config_data.get("DETECT_CACHE_SIZE", cls.DETECT_CACHE_SIZE)
+            cls.DETECT_CACHE_TTL = config_data.get("DETECT_CACHE_TTL", cls.DETECT_CACHE_TTL)
+            cls.TRANSLATE_BATCH_CHARS = config_data.get("TRANSLATE_BATCH_CHARS", cls.TRANSLATE_BATCH_CHARS)
+            cls.TRANSLATE_CACHE_SIZE = config_data.get("TRANSLATE_CACHE_SIZE", cls.TRANSLATE_CACHE_SIZE)
+            cls.TRANSLATE_CACHE_FILE = config_data.get("TRANSLATE_CACHE_FILE", cls.TRANSLATE_CACHE_FILE)
+            cls.TRANSLATE_CACHE_DISK_SIZE = config_data.get("TRANSLATE_CACHE_DISK_SIZE", cls.TRANSLATE_CACHE_DISK_SIZE)
+            cls.SPEECH_FORMAT = config_data.get("SPEECH_FORMAT", cls.SPEECH_FORMAT)
+            cls.SPEECH_BITRATE = config_data.get("SPEECH_BITRATE", cls.SPEECH_BITRATE)
+            cls.SPEECH_CHUNK_SIZE = config_data.get("SPEECH_CHUNK_SIZE", cls.SPEECH_CHUNK_SIZE)
+            cls.SPEECH_WORKERS = config_data.get("SPEECH_WORKERS", cls.SPEECH_WORKERS)
+            cls.SPEECH_DELIVERY = config_data.get("SPEECH_DELIVERY", cls.SPEECH_DELIVERY)
+            cls.SPEECH_STREAM_MIN_DURATION = config_data.get(
+                "SPEECH_STREAM_MIN_DURATION", cls.SPEECH_STREAM_MIN_DURATION
+            )
+            cls.SPEECH_STREAM_WINDOW = config_data.get("SPEECH_STREAM_WINDOW", cls.SPEECH_STREAM_WINDOW)
+            cls.TELEGRAM_DOWNLOAD_TIMEOUT = config_data.get("TELEGRAM_DOWNLOAD_TIMEOUT", cls.TELEGRAM_DOWNLOAD_TIMEOUT)
+            cls.SPEECH_RECOGNITION_FANOUT = config_data.get("SPEECH_RECOGNITION_FANOUT", cls.SPEECH_RECOGNITION_FANOUT)
+            cls.AUDIO_CACHE_SIZE = config_data.get("AUDIO_CACHE_SIZE", cls.AUDIO_CACHE_SIZE)
+            cls.AUDIO_CACHE_DIR = config_data.get("AUDIO_CACHE_DIR", cls.AUDIO_CACHE_DIR)
+            cls.AUDIO_CACHE_DISK_BYTES = config_data.get("AUDIO_CACHE_DISK_BYTES", cls.AUDIO_CACHE_DISK_BYTES)
+            cls.FILE_ID_CACHE_FILE = config_data.get("FILE_ID_CACHE_FILE", cls.FILE_ID_CACHE_FILE)
+            cls.IMAGE_DELIVERY = config_data.get("IMAGE_DELIVERY", cls.IMAGE_DELIVERY)
+            cls.IMAGE_DOWNLOAD_POOL_SIZE = config_data.get("IMAGE_DOWNLOAD_POOL_SIZE", cls.IMAGE_DOWNLOAD_POOL_SIZE)
+            cls.IMAGE_DOWNLOAD_TIMEOUT = config_data.get("IMAGE_DOWNLOAD_TIMEOUT", cls.IMAGE_DOWNLOAD_TIMEOUT)
+            cls.IMAGE_MAX_BYTES = config_data.get("IMAGE_MAX_BYTES", cls.IMAGE_MAX_BYTES)
+            cls.TRANSCRIPTION_CACHE_FILE = config_data.get("TRANSCRIPTION_CACHE_FILE", cls.TRANSCRIPTION_CACHE_FILE)
+            cls.TRANSCRIPTION_CACHE_SIZE = config_data.get("TRANSCRIPTION_CACHE_SIZE", cls.TRANSCRIPTION_CACHE_SIZE)
+            cls.TRANSCRIPTION_CACHE_TTL = config_data.get("TRANSCRIPTION_CACHE_TTL", cls.TRANSCRIPTION_CACHE_TTL)
             cls.API_KEY_TELEGRAM_BOT = config_data["API_KEY_TELEGRAM_BOT"]
             cls.ADMIN_IDS = config_data["ADMIN_IDS"]
+            cls.USER_STORAGE = config_data.get("USER_STORAGE", cls.USER_STORAGE)
+            cls.AUTOSAVE_INTERVAL = config_data.get("AUTOSAVE_INTERVAL", cls.AUTOSAVE_INTERVAL)
+            cls.USER_IDLE_TIMEOUT = config_data.get("USER_IDLE_TIMEOUT", cls.USER_IDLE_TIMEOUT)
+            cls.ASYNC_MODE = config_data.get("ASYNC_MODE", cls.ASYNC_MODE)
+            cls.DISPATCHER_WORKERS = config_data.get("DISPATCHER_WORKERS", cls.DISPATCHER_WORKERS)
+            cls.DISPATCHER_QUEUE_SIZE = config_data.get("DISPATCHER_QUEUE_SIZE", cls.DISPATCHER_QUEUE_SIZE)
+            cls.METRICS_PORT = config_data.get("METRICS_PORT", cls.METRICS_PORT)
+            cls.METRICS_HOST = config_data.get("METRICS_HOST", cls.METRICS_HOST)
 
 
 # Загрузка конфигурации
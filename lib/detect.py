@@ -0,0 +1,150 @@
+from collections import Counter
+import hashlib
+import re
+from typing import Callable, Iterable, Optional
+
+from lib.cache import LRUCache, StatsMixin
+
+
+# Алфавиты: диапазоны символов Unicode
+SCRIPT_RANGES = {
+    "latin": ((0x0041, 0x005A), (0x0061, 0x007A), (0x00C0, 0x024F), (0x02BB, 0x02BC)),
+    "cyrillic": ((0x0400, 0x052F),),
+    "greek": ((0x0370, 0x03FF),),
+    "hebrew": ((0x0590, 0x05FF),),
+    "arabic": ((0x0600, 0x06FF),),
+    "armenian": ((0x0530, 0x058F),),
+    "georgian": ((0x10A0, 0x10FF),),
+    "cjk": ((0x3040, 0x30FF), (0x4E00, 0x9FFF), (0xAC00, 0xD7AF)),
+}
+
+# Алфавит каждого языка
+LANG_SCRIPTS = {
+    "ru": "cyrillic",
+    "uk": "cyrillic",
+    "be": "cyrillic",
+    "kk": "cyrillic",
+    "en": "latin",
+    "de": "latin",
+    "es": "latin",
+    "fi": "latin",
+    "fr": "latin",
+    "it": "latin",
+    "nl": "latin",
+    "pl": "latin",
+    "pt": "latin",
+    "sv": "latin",
+    "tr": "latin",
+    "uz": "latin",
+    "el": "greek",
+    "he": "hebrew",
+    "ar": "arabic",
+    "hy": "armenian",
+    "ka": "georgian",
+}
+
+# Характерные n-граммы символов (с пробелами на границах слов) для языков с общим алфавитом
+LANG_NGRAMS = {
+    "ru": ("ы", "э", "ъ", "ё", " и ", " не ", " что", " это", "ого ", "ть ", " в ", " на ", "ся "),
+    "uk": ("і", "ї", "є", "ґ", " і ", " що", " це ", " не ", "ння"),
+    "be": ("ў", "і", " і ", " што", " гэта", " не "),
+    "kk": ("ә", "ғ", "қ", "ң", "ө", "ұ", "ү", "һ", " және", " бұл", "ның", "ды "),
+    "en": (" the ", " and ", " is ", " of ", " to ", " you ", "th", "ing ", " it ", " what", "ould"),
+    "de": ("ä", "ö", "ü", "ß", " der ", " die ", " und ", " ist ", " nicht", "sch", "ich ", " das "),
+    "es": ("ñ", "¿", "¡", " el ", " los ", " que ", " es ", " por ", "ción", " una ", " del "),
+    "fi": ("ä", "ö", " ja ", " on ", " ei ", "aa", "ii", "uu", "ssa ", "lla ", " se "),
+    "fr": ("ç", "è", "ê", " le ", " les ", " et ", " est ", " je ", " vous ", "eau", " des ", "tion "),
+    "it": (" il ", " che ", " di ", " è ", " non ", "zione", " per ", "gli ", " della", "cch"),
+    "nl": (" de ", " het ", " een ", " en ", " is ", "ij", "oe", " niet", " van ", "aa"),
+    "pl": ("ą", "ę", "ł", "ś", "ż", "ź", "ć", "ń", " nie ", " się", "prz", "cz", "sz"),
+    "pt": ("ã", "õ", "ç", " não", " que ", " os ", " um ", " uma ", "ção", " do ", " da "),
+    "sv": ("å", "ä", "ö", " och ", " är ", " det ", " att ", " som ", " inte", " jag "),
+    "tr": ("ı", "ğ", "ş", "ç", "ö", "ü", " bir ", " ve ", " bu ", "ler", "lar"),
+    "uz": ("oʻ", "gʻ", "o'", "g'", " va ", " bu ", "lar", "ning ", "sh", "ch", " men "),
+}
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def get_script(char: str) -> Optional[str]:
+    code = ord(char)
+    for script, ranges in SCRIPT_RANGES.items():
+        for start, end in ranges:
+            if start <= code <= end:
+                return script
+    return None
+
+
+# Доля букв каждого алфавита в тексте
+def get_scripts(text: str) -> dict:
+    counter = Counter(get_script(char) for char in text if char.isalpha())
+    counter.pop(None, None)
+    total = sum(counter.values())
+    return {script: count / total for script, count in counter.items()} if total else {}
+
+
+# Локальное определение языка среди языков пользователя: по алфавиту, затем по характерным n-граммам.
+# Возвращает None, если подсказок нет или уверенности нет
+def detect_local(text: str, hints: Iterable[str] = (), min_share: float = 0.8, min_ratio: float = 2.0) -> Optional[str]:
+    hints = tuple(hints)
+    if not hints:
+        return None
+    text = normalize_text(text)
+    scripts = get_scripts(text)
+    if not scripts:
+        return None
+    script, share = max(scripts.items(), key=lambda item: item[1])
+    if share < min_share:
+        return None
+    candidates = [lang for lang in hints if LANG_SCRIPTS.get(lang) == script]
+    if len(candidates) == 1:
+        return candidates[0]
+    candidates = [lang for lang in candidates if lang in LANG_NGRAMS]
+    if not candidates:
+        return None
+
+    padded = f" {text} "
+    scores = sorted(
+        ((sum(padded.count(ngram) for ngram in LANG_NGRAMS[lang]), lang) for lang in candidates), reverse=True
+    )
+    best_score, best_lang = scores[0]
+    second_score = scores[1][0] if len(scores) > 1 else 0
+    if best_score > 0 and best_score >= min_ratio * second_score:
+        return best_lang
+    return None
+
+
+# Определение языка: кэш, затем локальный классификатор, затем удалённый сервис
+class LanguageDetector(StatsMixin):
+    def __init__(self, maxsize: int = 4096, ttl: Optional[float] = None):
+        self.cache = LRUCache(maxsize, ttl)
+        self.local_hits = 0
+        self.remote_calls = 0
+
+    @staticmethod
+    def get_key(text: str, hints: Iterable[str]) -> tuple:
+        digest = hashlib.sha1(normalize_text(text).encode()).digest()
+        return digest, tuple(sorted(hints))
+
+    def detect(self, text: str, hints: Iterable[str], remote: Callable[[str], Optional[str]]) -> Optional[str]:
+        hints = tuple(hints)
+        key = self.get_key(text, hints)
+        lang = self.cache.get(key)
+        if lang is not None:
+            return lang
+        lang = detect_local(text, hints)
+        if lang is not None:
+            self.local_hits += 1
+        else:
+            self.remote_calls += 1
+            lang = remote(text)
+        if lang is not None:
+            self.cache.set(key, lang)
+        return lang
+
+    def get_stats(self) -> dict:
+        stats = self.cache.get_stats()
+        stats.update({"local": self.local_hits, "remote": self.remote_calls})
+        return stats
@@ -0,0 +1,225 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from lib.cache import StatsMixin
+
+
+logger = logging.getLogger(__name__)
+
+# Задача, которую выполняет текущий поток
+_current = threading.local()
+
+
+# Сколько секунд осталось задаче текущего потока: срок для сетевых вызовов внутри задачи.
+# Вне задачи и для задачи без таймаута возвращает default
+def time_left(default: Optional[float] = None, minimum: float = 1.0) -> Optional[float]:
+    task = getattr(_current, "task", None)
+    if task is None or task.timeout is None or task.started is None:
+        return default
+    left = max(task.started + task.timeout - time.monotonic(), minimum)
+    return left if default is None else min(left, default)
+
+
+# Переносит задачу текущего потока во вспомогательный пул, чтобы вызовы там видели её срок и отмену
+def bind_task(func: Callable) -> Callable:
+    task = getattr(_current, "task", None)
+
+    def wrapper(*args, **kwargs):
+        _current.task = task
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.task = None
+
+    return wrapper
+
+
+# Задача пользователя в очереди диспетчера
+class DispatcherTask:
+    def __init__(
+        self,
+        user_id: str,
+        func: Callable,
+        args: tuple = (),
+        kwargs: Optional[dict] = None,
+        timeout: Optional[float] = None,
+        on_timeout: Optional[Callable] = None,
+    ):
+        self.user_id = user_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.created = time.monotonic()
+        self.started: Optional[float] = None
+        self.expired = False
+        self.done = False
+        self.cancelled = threading.Event()
+
+
+# Диспетчер: ограниченный пул потоков, очередь FIFO для каждого пользователя,
+# параллельная обработка разных пользователей и отказ от задач по таймауту
+class Dispatcher(StatsMixin):
+    def __init__(self, max_workers: int = 8, max_queue: int = 10, wait_warning: float = 5.0):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.wait_warning = wait_warning
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dispatcher")
+        self._lock = threading.Lock()
+        self._queues: dict[str, deque] = {}
+        self._active: dict[str, DispatcherTask] = {}
+        # Один поток таймеров на все задачи: куча (срок, номер, задача)
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._timer_cond = threading.Condition(self._lock)
+        self._timer_thread: Optional[threading.Thread] = None
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "timeouts": 0,
+            "rejected": 0,
+            "abandoned": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+        }
+
+    def submit(
+        self,
+        user_id: str,
+        func: Callable,
+        args: tuple = (),
+        kwargs: Optional[dict] = None,
+        timeout: Optional[float] = None,
+        on_timeout: Optional[Callable] = None,
+    ) -> bool:
+        task = DispatcherTask(user_id, func, args, kwargs, timeout, on_timeout)
+        with self._lock:
+            queue = self._queues.setdefault(user_id, deque())
+            if len(queue) >= self.max_queue:
+                self._stats["rejected"] += 1
+                return False
+            queue.append(task)
+            self._stats["submitted"] += 1
+            if user_id not in self._active:
+                self._schedule_next(user_id)
+        return True
+
+    def is_active(self, user_id: str) -> bool:
+        with self._lock:
+            return user_id in self._active or bool(self._queues.get(user_id))
+
+    def is_cancelled(self) -> bool:
+        task = getattr(_current, "task", None)
+        return task is not None and task.cancelled.is_set()
+
+    def queue_depth(self) -> int:
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["workers"] = self.max_workers
+            stats["active"] = len(self._active)
+            stats["queued"] = sum(len(queue) for queue in self._queues.values())
+        started = stats["completed"] + stats["failed"] + stats["timeouts"]
+        stats["wait_avg"] = stats.pop("wait_total") / started if started else 0.0
+        return stats
+
+    def shutdown(self, wait: bool = False):
+        with self._lock:
+            self._timers.clear()
+            self._timer_cond.notify()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    # Вызывается под блокировкой
+    def _add_timer(self, task: DispatcherTask):
+        heapq.heappush(self._timers, (task.started + task.timeout, next(self._timer_seq), task))
+        if self._timer_thread is None:
+            self._timer_thread = threading.Thread(target=self._timer_loop, name="dispatcher-timer", daemon=True)
+            self._timer_thread.start()
+        self._timer_cond.notify()
+
+    def _timer_loop(self):
+        while True:
+            with self._lock:
+                while not self._timers or self._timers[0][0] > time.monotonic():
+                    self._timer_cond.wait(self._timers[0][0] - time.monotonic() if self._timers else None)
+                _, _, task = heapq.heappop(self._timers)
+            if not task.done:
+                self._expire(task)
+
+    # Вызывается под блокировкой
+    def _schedule_next(self, user_id: str):
+        queue = self._queues.get(user_id)
+        if not queue:
+            self._queues.pop(user_id, None)
+            self._active.pop(user_id, None)
+            return
+        task = queue.popleft()
+        self._active[user_id] = task
+        self._executor.submit(self._run, task)
+
+    def _run(self, task: DispatcherTask):
+        task.started = time.monotonic()
+        wait = task.started - task.created
+        with self._lock:
+            self._stats["wait_total"] += wait
+            self._stats["wait_max"] = max(self._stats["wait_max"], wait)
+        if wait > self.wait_warning:
+            logger.warning("User: %s, Dispatcher wait: %.2f s, Queue: %s", task.user_id, wait, self.queue_depth())
+
+        # Задача простояла в очереди дольше таймаута: отменяем её, не начиная
+        if task.timeout is not None and wait >= task.timeout:
+            self._expire(task, running=False)
+            self._finish(task, False)
+            return
+
+        if task.timeout is not None:
+            with self._lock:
+                self._add_timer(task)
+        _current.task = task
+        failed = False
+        try:
+            task.func(*task.args, **task.kwargs)
+        except Exception as ex:
+            failed = True
+            logger.error("User: %s, Dispatcher task error: %s", task.user_id, ex)
+        finally:
+            _current.task = None
+            self._finish(task, failed)
+
+    # Пользователь получает сообщение о таймауте, задача видит отмену через is_cancelled(),
+    # а очередь пользователя продолжается, не дожидаясь возврата из зависшей задачи
+    def _expire(self, task: DispatcherTask, running: bool = True):
+        with self._lock:
+            if task.done or task.expired:
+                return
+            task.expired = True
+            task.cancelled.set()
+            self._stats["timeouts"] += 1
+            if running:
+                self._stats["abandoned"] += 1
+            if self._active.get(task.user_id) is task:
+                self._schedule_next(task.user_id)
+        if task.on_timeout:
+            try:
+                task.on_timeout()
+            except Exception as ex:
+                logger.error("User: %s, Dispatcher timeout handler error: %s", task.user_id, ex)
+
+    def _finish(self, task: DispatcherTask, failed: bool):
+        with self._lock:
+            task.done = True
+            # Очередь отменённой задачи уже продолжена в _expire
+            if not task.expired:
+                self._stats["failed" if failed else "completed"] += 1
+                self._schedule_next(task.user_id)
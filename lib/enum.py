@@ -0,0 +1,95 @@
+from collections.abc import Mapping
+from types import MappingProxyType
+from typing import Any, Iterator, Optional
+
+
+def fold(text: str) -> str:
+    return text.strip().casefold()
+
+
+# Неизменяемое меню: подпись -> значение, с поиском подписи без учёта регистра и пробелов по краям
+class EnumMenu(Mapping):
+    __slots__ = ("_items", "_folded")
+
+    def __init__(self, items: dict):
+        self._items = MappingProxyType(dict(items))
+        self._folded = MappingProxyType({fold(key): val for key, val in self._items.items()})
+
+    def __getitem__(self, key: str) -> Any:
+        return self._items[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def has(self, text: str) -> bool:
+        return fold(text) in self._folded
+
+    def find(self, text: str, default: Any = None) -> Any:
+        return self._folded.get(fold(text), default)
+
+    # Новое меню с дополнительными пунктами, исходное не меняется
+    def extend(self, items: dict) -> "EnumMenu":
+        return EnumMenu({**self._items, **items})
+
+
+# Метакласс перечислений: индексы значений и меню строятся один раз при создании класса
+class EnumMeta(type):
+    def __new__(mcs, name, bases, namespace):
+        cls = super().__new__(mcs, name, bases, namespace)
+        items = tuple(
+            (attr, val)
+            for attr, val in namespace.items()
+            if not attr.startswith("_") and not callable(val) and not isinstance(val, (classmethod, staticmethod))
+        )
+        cls._keys = tuple(attr for attr, _ in items)
+        cls._values = tuple(val for _, val in items)
+        cls._key_index = MappingProxyType({val: attr for attr, val in items})
+        cls._value_index = MappingProxyType(dict(items))
+        cls._menus = {}
+        if items:
+            cls.get_menu()
+            cls.get_menu(capitalize=False)
+        return cls
+
+
+class BaseEnum(metaclass=EnumMeta):
+    @classmethod
+    def get_keys(cls) -> tuple:
+        return cls._keys
+
+    @classmethod
+    def get_values(cls) -> tuple:
+        return cls._values
+
+    @classmethod
+    def get_key(cls, val: Any) -> Optional[str]:
+        return cls._key_index.get(val)
+
+    @classmethod
+    def get_value(cls, key: str) -> Any:
+        return cls._value_index.get(key)
+
+    @classmethod
+    def has_value(cls, val: Any) -> bool:
+        return val in cls._key_index
+
+    # Меню для выбора значения: для строк подписью служит само значение, для кортежей - элемент idx
+    @classmethod
+    def get_menu(cls, idx: int = 0, capitalize: bool = True) -> EnumMenu:
+        key = (idx, capitalize)
+        menu = cls._menus.get(key)
+        if menu is None:
+            if cls._values and isinstance(cls._values[0], str):
+                func_str = (lambda s: s.strip().capitalize()) if capitalize else (lambda s: s.strip())
+                menu = EnumMenu({func_str(item): item for item in cls._values})
+            else:
+                menu = EnumMenu({item[idx]: item for item in cls._values})
+            cls._menus[key] = menu
+        return menu
+
+
+class BaseEnumTuple(BaseEnum):
+    pass
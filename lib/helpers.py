@@ -1,21 +1,49 @@
 from functools import wraps
+import hashlib
+from io import BytesIO
 import logging
 import re
-import threading
-from typing import Any, Optional, Union
+import time
+from typing import Any, Iterator, Optional, Union
 
-from telebot import TeleBot
-from telebot.types import ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telebot import TeleBot, apihelper
+from telebot.apihelper import ApiTelegramException
+from telebot.types import Message, ReplyKeyboardMarkup, ReplyKeyboardRemove
 
+from lib.aio import AsyncTeleBotBridge, aio_loop
+from lib.cache import SQLiteCache
 from lib.config import Config
+from lib.dispatcher import Dispatcher
+from lib.enum import EnumMenu
 from lib.errors import NotFoundHandler
-from lib.users import UserStorage
+from lib.history_log import HistoryLog
+from lib.http import create_session
+from lib.metrics import command_timeouts, handler_errors, instrument_methods, stage_seconds
+from lib.users import create_user_storage
 
 
 logger = logging.getLogger(__name__)
 
-bot = TeleBot(Config.API_KEY_TELEGRAM_BOT)
-user_storage = UserStorage("users.json")
+bot = AsyncTeleBotBridge(Config.API_KEY_TELEGRAM_BOT, aio_loop) if aio_loop else TeleBot(Config.API_KEY_TELEGRAM_BOT)
+# Длительность запросов к Telegram для метрик
+telegram_send_methods = ("send_message", "send_photo", "send_voice", "send_media_group", "edit_message_text")
+instrument_methods(bot, telegram_send_methods, stage_seconds, "telegram_send")
+instrument_methods(bot, ("download_file",), stage_seconds, "telegram_download")
+history_log = HistoryLog(Config.HISTORY_LOG_DIR, Config.HISTORY_LOG_COMPRESSION) if Config.HISTORY_LOG_DIR else None
+user_storage = create_user_storage(
+    Config.USER_STORAGE, history_log=history_log, history_last=Config.HISTORY_LOAD_MESSAGES or None
+)
+dispatcher = Dispatcher(Config.DISPATCHER_WORKERS, Config.DISPATCHER_QUEUE_SIZE)
+# Хэш содержимого аудио -> file_id, который вернул Telegram после первой загрузки
+voice_file_ids = SQLiteCache(Config.FILE_ID_CACHE_FILE, "voice_file_ids")
+# file_unique_id голосового сообщения и язык распознавания -> распознанный текст
+transcriptions = SQLiteCache(
+    Config.TRANSCRIPTION_CACHE_FILE,
+    "transcriptions",
+    maxsize=Config.TRANSCRIPTION_CACHE_SIZE,
+    ttl=Config.TRANSCRIPTION_CACHE_TTL,
+)
+download_session = create_session()
 hide_markup = ReplyKeyboardRemove()
 
 
@@ -37,6 +65,7 @@ class StateHandlerDecorator:
                 result = self._handlers[state](*args, **kwargs)
             except Exception as ex:
                 logger.error("Error handler %s. State %s: %s", self._name, state, ex)
+                handler_errors.inc(self._name, state[-1] if isinstance(state, tuple) else state)
                 raise
             return result
         elif None in self._handlers:
@@ -44,6 +73,7 @@ class StateHandlerDecorator:
                 result = self._handlers[None](*args, **kwargs)
             except Exception as ex:
                 logger.error("Error else-handler %s. Exeption: %s", self._name, ex)
+                handler_errors.inc(self._name, "None")
                 raise
             return result
         else:
@@ -56,12 +86,14 @@ def check_message(
     bot: "TeleBot",
     user_id: str,
     user_input: str,
-    choises: list[str],
+    choises: Union[list[str], EnumMenu],
     is_markup: Union[bool, list] = True,
     msg_error: str = None,
 ) -> bool:
-    user_input = user_input.strip().lower()
-    if user_input in map(lambda arg: arg.lower(), choises):
+    if isinstance(choises, EnumMenu):
+        if choises.has(user_input):
+            return True
+    elif user_input.strip().lower() in map(lambda arg: arg.lower(), choises):
         return True
     if msg_error is None:
         msg_error = "Неверный ответ. Попробуйте ещё..."
@@ -76,6 +108,54 @@ def check_message(
     return False
 
 
+# Отправка голосового сообщения: повторное аудио отправляется по file_id без загрузки
+def send_voice_cached(user_id: str, audio_stream: BytesIO, **kwargs) -> Optional[str]:
+    key = hashlib.sha1(audio_stream.getvalue()).hexdigest()
+    file_id = voice_file_ids.get(key)
+    if file_id:
+        try:
+            bot.send_voice(user_id, file_id, **kwargs)
+            return file_id
+        except ApiTelegramException as ex:
+            logger.warning("User: %s, Voice file_id is not valid: %s", user_id, ex)
+            voice_file_ids.pop(key)
+    audio_stream.seek(0)
+    message = bot.send_voice(user_id, audio_stream, **kwargs)
+    media = message.voice or message.audio or message.document
+    if media:
+        voice_file_ids.set(key, media.file_id)
+        return media.file_id
+    return None
+
+
+# Скачивание файла Telegram по частям: части отдаются по мере получения, файл целиком не хранится.
+# abort() закрывает соединение из другого потока, чтобы чтение не ждало следующей части из сети
+class FileChunks:
+    def __init__(self, file_path: str, chunk_size: int = 64 * 1024):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.response = None
+        self.aborted = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        if aio_loop:
+            yield bot.download_file(self.file_path)
+            return
+        file_url = apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}"
+        url = file_url.format(Config.API_KEY_TELEGRAM_BOT, self.file_path)
+        self.response = download_session.get(url, stream=True, timeout=(3.05, Config.TELEGRAM_DOWNLOAD_TIMEOUT))
+        with self.response as response:
+            if self.aborted:
+                return
+            response.raise_for_status()
+            yield from response.iter_content(self.chunk_size)
+
+    def abort(self):
+        self.aborted = True
+        if self.response is not None:
+            self.response.close()
+
+
 def send_message_admin(text: str):
     for user_id in Config.ADMIN_IDS:
         bot.send_message(user_id, text, reply_markup=hide_markup)
@@ -129,15 +209,16 @@ def cut_long_message(msg: str, length: int) -> str:
     return msg[:length] + "..." if len(msg) > length else msg
 
 
-# Декоратор для команды с учётом таймаута
+# Декоратор для команды с учётом таймаута: выполнение в пуле диспетчера,
+# сообщения одного пользователя обрабатываются по очереди
 def command_with_timeout(timeout):
     def decorator(func):
         @wraps(func)
         def wrapper(message, *args, **kwargs):
             user_id = message.chat.id
-            text = message.text
+            text = message.text or ""
 
-            def thread_function():
+            def task_function():
                 try:
                     func(message, *args, **kwargs)
                 except Exception as ex:
@@ -145,21 +226,93 @@ def command_with_timeout(timeout):
                     logger.error(ex)
                     bot.send_message(user_id, f"Команда не была выполнена из-за ошибки: {error_text}")
 
-            thread = threading.Thread(target=thread_function)
-            thread.start()
-            thread.join(timeout=timeout)
-            if thread.is_alive():
+            def timeout_function():
+                command_timeouts.inc(text.split()[0] if text.startswith("/") else "message")
                 bot.send_message(user_id, "Команда не была выполнена из-за таймаута!")
                 if text.startswith("/"):
                     logger.error(f"Таймаут команды {text} истёк, прекращаем её выполнение!")
                 else:
                     logger.error(f"Таймаут обработчика истёк, прекращаем его выполнение!")
 
+            if not dispatcher.submit(str(user_id), task_function, timeout=timeout, on_timeout=timeout_function):
+                logger.warning("User: %s, Dispatcher queue is full", user_id)
+                bot.send_message(user_id, "Слишком много запросов. Дождитесь ответа на предыдущие сообщения.")
+
         return wrapper
 
     return decorator
 
 
+# Сообщение, которое обновляется на месте по мере генерации ответа.
+# Правки ограничены по частоте, текст длиннее length переносится в следующие сообщения
+class StreamMessage:
+    def __init__(
+        self,
+        bot: "TeleBot",
+        user_id: str,
+        message: Optional[Message] = None,
+        length: int = 4000,
+        interval: float = 1.0,
+    ):
+        self.bot = bot
+        self.user_id = user_id
+        self.message = message
+        self.length = length
+        self.interval = interval
+        self.content = ""
+        self.text = ""
+        self.sent_text = ""
+        self.last_edit = 0.0
+
+    def add(self, delta: str):
+        self.content += delta
+        self.text += delta
+        while len(self.text) > self.length:
+            pos = self.text.rfind("\n", 0, self.length)
+            if pos <= 0:
+                pos = self.text.rfind(" ", 0, self.length)
+            if pos <= 0:
+                pos = self.length
+            self._update(self.text[:pos], final=True)
+            self.text = self.text[pos:].lstrip()
+            self.message = None
+        if time.monotonic() - self.last_edit >= self.interval:
+            self._update(self.text)
+
+    def finish(self):
+        if self.text:
+            self._update(self.text, final=True)
+
+    def _update(self, text: str, final: bool = False):
+        text = text.rstrip()
+        if not text or text == self.sent_text and not final:
+            return
+        try:
+            self._send(text, "Markdown" if final else None)
+        except ApiTelegramException as ex:
+            logger.warning("User: %s, Stream message error: %s", self.user_id, ex)
+            retry_after = get_retry_after(ex)
+            if not final:
+                # Следующая правка не раньше, чем через интервал и время ожидания от Telegram
+                self.last_edit = time.monotonic() + retry_after
+                return
+            time.sleep(retry_after)
+            self._send(text, None)
+        self.sent_text = text
+        self.last_edit = time.monotonic()
+
+    def _send(self, text: str, parse_mode: Optional[str]):
+        if self.message is None:
+            self.message = self.bot.send_message(self.user_id, text, parse_mode=parse_mode)
+        elif text != self.sent_text or parse_mode:
+            self.bot.edit_message_text(text, self.user_id, self.message.message_id, parse_mode=parse_mode)
+
+
+# Время ожидания в секундах, которое Telegram передаёт при ошибке 429
+def get_retry_after(ex: ApiTelegramException) -> int:
+    return (ex.result_json or {}).get("parameters", {}).get("retry_after", 0)
+
+
 # Проверяет сообщение на вхождение его в цепочку
 def is_message_chain(message) -> bool:
     user_input = message.text
@@ -0,0 +1,139 @@
+import hashlib
+import logging
+from typing import Callable, Optional
+
+from lib.cache import LRUCache
+
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+logger = logging.getLogger(__name__)
+
+# Служебные токены, которые добавляются к каждому сообщению чата
+MESSAGE_TOKENS = 4
+SUMMARY_PREFIX = "Краткое содержание предыдущей части диалога: "
+
+
+# Подсчёт токенов в тексте для модели
+def count_tokens(text: str, model: str) -> int:
+    if tiktoken is None:
+        # Грубая оценка без токенизатора: кириллица занимает больше токенов, чем латиница
+        return len(text) // 2 + 1
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return len(encoding.encode(text))
+
+
+# Начало текста, которое укладывается в tokens токенов модели
+def truncate_text(text: str, tokens: int, model: str) -> str:
+    if tiktoken is None:
+        return text[: max(tokens - 1, 0) * 2]
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return encoding.decode(encoding.encode(text)[:tokens])
+
+
+# Управление историей диалога в рамках бюджета токенов модели
+class HistoryManager:
+    def __init__(
+        self,
+        budgets: Optional[dict] = None,
+        default_budget: Optional[int] = None,
+        summarize: Optional[Callable[[list, str], str]] = None,
+    ):
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.summarize = summarize
+        # Кэш числа токенов по хэшу сообщения, чтобы не токенизировать историю на каждом шаге
+        self.token_cache = LRUCache(maxsize=65536)
+
+    def get_budget(self, model: str) -> Optional[int]:
+        return self.budgets.get(model, self.default_budget)
+
+    def message_tokens(self, message: dict, model: str) -> int:
+        digest = hashlib.sha1(f"{message['role']}\n{message['content']}".encode()).digest()
+        key = (model, digest)
+        tokens = self.token_cache.get(key)
+        if tokens is None:
+            tokens = count_tokens(message["content"], model) + MESSAGE_TOKENS
+            self.token_cache.set(key, tokens)
+        return tokens
+
+    def history_tokens(self, history: list, model: str) -> int:
+        return sum(self.message_tokens(message, model) for message in history)
+
+    @staticmethod
+    def is_summary(message: dict) -> bool:
+        return message["role"] == "system" and message["content"].startswith(SUMMARY_PREFIX)
+
+    # Резюме удаляемых сообщений: сообщения резюмируются частями в пределах бюджета вместе с резюме
+    # предыдущих частей. Сообщение, которое не помещается в бюджет рядом с резюме, сокращается, а не теряется
+    def summarize_evicted(self, previous: Optional[dict], evicted: list, model: str, budget: int) -> Optional[dict]:
+        summary = previous
+        batch = []
+        total = self.message_tokens(summary, model) if summary else 0
+        for message in evicted:
+            tokens = self.message_tokens(message, model)
+            if batch and total + tokens > budget:
+                summary = self._summarize_batch(summary, batch, model)
+                batch = []
+                total = self.message_tokens(summary, model)
+            if total + tokens > budget:
+                content = truncate_text(message["content"], max(budget - total - MESSAGE_TOKENS, 1), model)
+                message = {"role": message["role"], "content": content}
+                tokens = self.message_tokens(message, model)
+            batch.append(message)
+            total += tokens
+        if batch:
+            summary = self._summarize_batch(summary, batch, model)
+        return summary
+
+    def _summarize_batch(self, summary: Optional[dict], batch: list, model: str) -> dict:
+        text = self.summarize(([summary] if summary else []) + batch, model)
+        return {"role": "system", "content": SUMMARY_PREFIX + text}
+
+    def trim(self, history: list, model: str) -> list:
+        budget = self.get_budget(model)
+        if not budget:
+            return []
+        tokens = [self.message_tokens(message, model) for message in history]
+        total = sum(tokens)
+        if total <= budget:
+            return []
+
+        # Системное сообщение закреплено, последнее сообщение пользователя не удаляется
+        start = 1 if history and history[0]["role"] == "system" else 0
+        if start < len(history) and self.is_summary(history[start]):
+            start += 1
+        end = start
+        while end < len(history) - 1 and total > budget:
+            total -= tokens[end]
+            end += 1
+        evicted = history[start:end]
+        if not evicted:
+            return []
+
+        summary = None
+        if self.summarize:
+            previous = history[start - 1] if start > 0 and self.is_summary(history[start - 1]) else None
+            try:
+                summary = self.summarize_evicted(previous, evicted, model, budget)
+            except Exception as ex:
+                logger.error("History summarize error: %s", ex)
+            if summary and previous:
+                start -= 1
+        history[start:end] = [summary] if summary else []
+        logger.info("History trimmed: %s messages, model: %s, budget: %s", len(evicted), model, budget)
+
+        # Если резюме не уложилось в бюджет, удаляем ещё сообщения без резюмирования
+        while self.history_tokens(history, model) > budget and len(history) - 1 > start + bool(summary):
+            del history[start + bool(summary)]
+        return evicted
@@ -0,0 +1,292 @@
+import hashlib
+import logging
+import os
+import struct
+import threading
+from typing import Optional
+import zlib
+
+from lib.history import HistoryManager
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+# Запись: заголовок (длина данных, тип, флаги), данные и длина данных ещё раз,
+# чтобы файл можно было читать с конца
+HEADER = struct.Struct("<IBB")
+TRAILER = struct.Struct("<I")
+
+RECORD_MESSAGE = 1  # role\0content
+RECORD_PROMPT_REF = 2  # role\0digest системного сообщения из общего хранилища
+RECORD_RESET = 3  # история начинается заново
+RECORD_PROMPT = 4  # digest + текст системного сообщения (только в файле системных сообщений)
+RECORD_EDIT = 5  # keep + записи начальных сообщений: история сокращена до них и keep последних сообщений
+
+FLAG_ZLIB = 1
+FLAG_ZSTD = 2
+
+RECORD_KINDS = (RECORD_MESSAGE, RECORD_PROMPT_REF, RECORD_RESET, RECORD_PROMPT, RECORD_EDIT)
+EDIT_KEEP = struct.Struct("<I")
+
+DIGEST_SIZE = 16
+PROMPTS_FILE = "_prompts.log"
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=DIGEST_SIZE).digest()
+
+
+# Журнал истории диалогов: отдельный файл на пользователя, сообщения только дописываются.
+# Системные сообщения хранятся один раз в общем файле, в журнале - ссылка на них
+class HistoryLog:
+    def __init__(self, directory: str, compression: Optional[str] = "zlib", min_compress: int = 256):
+        self.directory = directory
+        self.min_compress = min_compress
+        if compression == "zstd" and zstandard is None:
+            logger.warning("zstandard is not installed, history log uses zlib")
+            compression = "zlib"
+        self.compression = compression
+        self._zstd_compressor = zstandard.ZstdCompressor() if compression == "zstd" else None
+        self._zstd_decompressor = zstandard.ZstdDecompressor() if zstandard else None
+        self._lock = threading.Lock()
+        self._prompts = {}
+        self._prompts_end = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_prompts()
+
+    def _path(self, user_id: str) -> str:
+        return os.path.join(self.directory, f"{user_id}.log")
+
+    def exists(self, user_id: str) -> bool:
+        return os.path.exists(self._path(user_id))
+
+    def _encode(self, kind: int, payload: bytes) -> bytes:
+        flags = 0
+        if self.compression and len(payload) >= self.min_compress:
+            if self._zstd_compressor is not None:
+                payload, flags = self._zstd_compressor.compress(payload), FLAG_ZSTD
+            else:
+                payload, flags = zlib.compress(payload), FLAG_ZLIB
+        return HEADER.pack(len(payload), kind, flags) + payload + TRAILER.pack(len(payload))
+
+    def _decode(self, flags: int, payload: bytes) -> bytes:
+        if flags & FLAG_ZSTD:
+            if self._zstd_decompressor is None:
+                raise RuntimeError("History log record is compressed with zstd, install zstandard to read it")
+            return self._zstd_decompressor.decompress(payload)
+        if flags & FLAG_ZLIB:
+            return zlib.decompress(payload)
+        return payload
+
+    # Записи файла с начала до первой повреждённой: (начало, тип, флаги, данные) и конец последней целой записи
+    @staticmethod
+    def _scan(data: bytes) -> (list, int):
+        records = []
+        pos = 0
+        while pos + HEADER.size + TRAILER.size <= len(data):
+            length, kind, flags = HEADER.unpack_from(data, pos)
+            start = pos + HEADER.size
+            end = start + length + TRAILER.size
+            if kind not in RECORD_KINDS or end > len(data):
+                break
+            if TRAILER.unpack_from(data, end - TRAILER.size)[0] != length:
+                break
+            records.append((pos, kind, flags, data[start : start + length]))
+            pos = end
+        return records, pos
+
+    def _load_prompts(self):
+        path = os.path.join(self.directory, PROMPTS_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as file:
+            records, self._prompts_end = self._scan(file.read())
+        for _, _, flags, payload in records:
+            payload = self._decode(flags, payload)
+            self._prompts[payload[:DIGEST_SIZE]] = payload[DIGEST_SIZE:].decode()
+
+    # Системное сообщение сохраняется один раз, дальше используется его digest.
+    # Запись попадает на диск до записей журнала, которые на неё ссылаются
+    def _intern(self, text: str) -> bytes:
+        digest = _digest(text)
+        if digest not in self._prompts:
+            path = os.path.join(self.directory, PROMPTS_FILE)
+            data = self._encode(RECORD_PROMPT, digest + text.encode())
+            with open(path, "ab") as file:
+                # Недописанная запись после сбоя отбрасывается
+                if file.tell() > self._prompts_end:
+                    file.truncate(self._prompts_end)
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            self._prompts_end += len(data)
+            self._prompts[digest] = text
+        return digest
+
+    def _encode_message(self, message: dict) -> bytes:
+        role = message["role"].encode()
+        if message["role"] == "system" and not HistoryManager.is_summary(message):
+            return self._encode(RECORD_PROMPT_REF, role + b"\0" + self._intern(message["content"]))
+        return self._encode(RECORD_MESSAGE, role + b"\0" + message["content"].encode())
+
+    def _decode_message(self, kind: int, payload: bytes) -> Optional[dict]:
+        role, content = payload.split(b"\0", 1)
+        if kind == RECORD_PROMPT_REF:
+            prompt = self._prompts.get(content)
+            if prompt is None:
+                logger.warning("History log: unknown system prompt %s", content.hex())
+                return None
+            return {"role": role.decode(), "content": prompt}
+        return {"role": role.decode(), "content": content.decode()}
+
+    # Запись, которая заканчивается в позиции end: (начало, длина, тип, флаги) или None, если она повреждена
+    @staticmethod
+    def _record_before(file, end: int) -> Optional[tuple]:
+        if end < HEADER.size + TRAILER.size:
+            return None
+        file.seek(end - TRAILER.size)
+        (length,) = TRAILER.unpack(file.read(TRAILER.size))
+        start = end - TRAILER.size - length - HEADER.size
+        if start < 0:
+            return None
+        file.seek(start)
+        header_length, kind, flags = HEADER.unpack(file.read(HEADER.size))
+        if header_length != length or kind not in RECORD_KINDS:
+            return None
+        return start, length, kind, flags
+
+    # Хвост, недописанный при сбое, отрезается по концу последней целой записи
+    def _repair(self, path: str) -> int:
+        with open(path, "r+b") as file:
+            _, end = self._scan(file.read())
+            file.truncate(end)
+        logger.warning("History log: damaged tail truncated, %s, %s bytes kept", path, end)
+        return end
+
+    # Вызывается под блокировкой
+    def _check_tail(self, path: str):
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as file:
+            end = file.seek(0, os.SEEK_END)
+            is_valid = end == 0 or self._record_before(file, end) is not None
+        if not is_valid:
+            self._repair(path)
+
+    def append(self, user_id: str, messages: list) -> int:
+        with self._lock:
+            data = b"".join(self._encode_message(message) for message in messages)
+            path = self._path(user_id)
+            self._check_tail(path)
+            with open(path, "ab") as file:
+                file.write(data)
+        return len(data)
+
+    # История изменилась не только в конце: маркер сброса и история целиком.
+    # Когда старых записей становится много, файл переписывается
+    def reset(self, user_id: str, messages: list) -> int:
+        with self._lock:
+            return self._reset(user_id, messages)
+
+    # Вызывается под блокировкой
+    def _reset(self, user_id: str, messages: list) -> int:
+        data = self._encode(RECORD_RESET, b"") + b"".join(self._encode_message(message) for message in messages)
+        path = self._path(user_id)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size > 4 * len(data) and size > 64 * 1024:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        else:
+            self._check_tail(path)
+            with open(path, "ab") as file:
+                file.write(data)
+        return len(data)
+
+    # История сокращена или резюмирована: history = history[:start] + keep последних сообщений журнала
+    # + новые сообщения. Дописываются только начальные и новые сообщения, без перезаписи истории.
+    # Когда старых записей становится много, журнал переписывается целиком
+    def edit(self, user_id: str, history: list, start: int, keep: int) -> int:
+        with self._lock:
+            path = self._path(user_id)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            if size > 64 * 1024 and size > 4 * sum(len(message["content"]) for message in history):
+                return self._reset(user_id, history)
+            head = b"".join(self._encode_message(message) for message in history[:start])
+            data = self._encode(RECORD_EDIT, EDIT_KEEP.pack(keep) + head)
+            data += b"".join(self._encode_message(message) for message in history[start + keep :])
+            self._check_tail(path)
+            with open(path, "ab") as file:
+                file.write(data)
+        return len(data)
+
+    # Чтение с конца файла до маркера сброса или до last сообщений.
+    # Повреждённая запись считается концом файла: хвост отрезается, чтение повторяется
+    def read(self, user_id: str, last: Optional[int] = None) -> list:
+        path = self._path(user_id)
+        if not os.path.exists(path):
+            return []
+        with self._lock:
+            messages = self._read_backward(path, last)
+            if messages is None:
+                self._repair(path)
+                messages = self._read_backward(path, last) or []
+        messages.reverse()
+        return messages
+
+    # Сообщения от конца файла к началу; None, если встретилась повреждённая запись.
+    # Правка берёт keep последних сообщений из истории до неё, поэтому правки образуют стек:
+    # [сколько сообщений ещё взять из истории до правки, начальные сообщения правки]
+    def _read_backward(self, path: str, last: Optional[int] = None) -> Optional[list]:
+        messages = []
+        edits = []
+
+        def is_open() -> bool:
+            return (last is None or len(messages) < last) and all(edit[0] > 0 for edit in edits)
+
+        def take(message: dict):
+            messages.append(message)
+            for edit in edits:
+                edit[0] -= 1
+
+        with open(path, "rb") as file:
+            pos = file.seek(0, os.SEEK_END)
+            while pos > 0 and is_open():
+                record = self._record_before(file, pos)
+                if record is None:
+                    return None
+                start, length, kind, flags = record
+                if kind == RECORD_RESET:
+                    break
+                file.seek(start + HEADER.size)
+                payload = self._decode(flags, file.read(length))
+                if kind == RECORD_EDIT:
+                    (keep,) = EDIT_KEEP.unpack_from(payload)
+                    records, _ = self._scan(payload[EDIT_KEEP.size :])
+                    head = [self._decode_message(item[1], self._decode(item[2], item[3])) for item in records]
+                    edits.append([keep, [message for message in head if message is not None]])
+                else:
+                    message = self._decode_message(kind, payload)
+                    if message is not None:
+                        take(message)
+                pos = start
+        # История до правки прочитана: добавляем начальные сообщения правок от внутренней к внешней
+        while edits:
+            _, head = edits.pop()
+            for message in reversed(head):
+                if not is_open():
+                    break
+                take(message)
+        return messages
+
+    def remove(self, user_id: str):
+        with self._lock:
+            if os.path.exists(self._path(user_id)):
+                os.remove(self._path(user_id))
@@ -0,0 +1,100 @@
+from io import BytesIO
+import logging
+import threading
+import time
+from typing import Any, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from lib.cache import StatsMixin
+
+
+logger = logging.getLogger(__name__)
+
+
+# Коды ответа, после которых запрос повторяется с задержкой
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+# Сессия HTTP с пулом keep-alive соединений и повторами с задержкой для 429/5xx
+def create_session(pool_size: int = 10, retries: int = 3, backoff: float = 0.5) -> requests.Session:
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Загрузка файлов по ссылке через общий пул соединений: общий таймаут, ограничение размера и статистика
+class Downloader(StatsMixin):
+    def __init__(
+        self,
+        pool_size: int = 4,
+        timeout: float = 60.0,
+        max_bytes: int = 10 * 1024 * 1024,
+        chunk_size: int = 64 * 1024,
+        aio: Optional[Any] = None,
+    ):
+        self.session = create_session(pool_size)
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.aio = aio
+        self._lock = threading.Lock()
+        self._stats = {
+            "downloads": 0,
+            "errors": 0,
+            "last_bytes": 0,
+            "bytes_total": 0,
+            "last_time": 0.0,
+            "max_time": 0.0,
+        }
+
+    def get(self, url: str) -> BytesIO:
+        started = time.monotonic()
+        try:
+            if self.aio:
+                buffer = BytesIO(self.aio.run(self.aio.get_bytes(url, self.timeout, self.max_bytes)))
+            else:
+                buffer = self._get(url, started)
+        except Exception:
+            with self._lock:
+                self._stats["errors"] += 1
+            raise
+        elapsed = time.monotonic() - started
+        size = buffer.getbuffer().nbytes
+        with self._lock:
+            self._stats["downloads"] += 1
+            self._stats["last_bytes"] = size
+            self._stats["bytes_total"] += size
+            self._stats["last_time"] = elapsed
+            self._stats["max_time"] = max(self._stats["max_time"], elapsed)
+        logger.info("Download: %s bytes, %.3f s", size, elapsed)
+        buffer.seek(0)
+        return buffer
+
+    def _get(self, url: str, started: float) -> BytesIO:
+        buffer = BytesIO()
+        # Таймаут чтения в requests действует на каждый блок, поэтому общее время проверяется отдельно
+        with self.session.get(url, stream=True, timeout=(3.05, self.timeout)) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(self.chunk_size):
+                buffer.write(chunk)
+                if buffer.tell() > self.max_bytes:
+                    raise ValueError(f"Download exceeds {self.max_bytes} bytes")
+                if time.monotonic() - started > self.timeout:
+                    raise TimeoutError(f"Download exceeds {self.timeout} s")
+        return buffer
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
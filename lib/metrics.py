@@ -0,0 +1,200 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+import time
+from typing import Callable, Iterator
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_str(names: tuple, values: tuple, extra: str = "") -> str:
+    items = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        items.append(extra)
+    return "{" + ",".join(items) + "}" if items else ""
+
+
+# Счётчик с метками, значения только растут
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, value: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + value
+
+    def collect(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_labels_str(self.labelnames, labels)} {value}"
+
+
+# Гистограмма длительностей с накопительными корзинами, как в Prometheus
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(labels)
+            if item is None:
+                item = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            item[0][idx] += 1
+            item[1] += value
+            item[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    # Декоратор: длительность каждого вызова функции
+    def timed(self, *labels) -> Callable:
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(*labels):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def collect(self) -> Iterator[str]:
+        with self._lock:
+            values = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self._values.items()]
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _labels_str(self.labelnames, labels, f'le="{bound}"')
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            bucket_labels = _labels_str(self.labelnames, labels, 'le="+Inf"')
+            yield f"{self.name}_bucket{bucket_labels} {count}"
+            yield f"{self.name}_sum{_labels_str(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_labels_str(self.labelnames, labels)} {count}"
+
+
+# Значения, которые считываются в момент запроса: функция возвращает {метки: значение}
+class GaugeFunc:
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._funcs = []
+
+    def add(self, func: Callable[[], dict]):
+        self._funcs.append(func)
+
+    def collect(self) -> Iterator[str]:
+        for func in self._funcs:
+            try:
+                values = func()
+            except Exception as ex:
+                logger.warning("Metric %s error: %s", self.name, ex)
+                continue
+            for labels, value in values.items():
+                yield f"{self.name}{_labels_str(self.labelnames, labels)} {value}"
+
+
+# Накопительные счётчики, которые считываются в момент запроса, например попадания в кэш
+class CounterFunc(GaugeFunc):
+    kind = "counter"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def to_text(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+stage_seconds = registry.register(Histogram("aibot_stage_seconds", "Duration of message pipeline stages", ("stage",)))
+openai_seconds = registry.register(Histogram("aibot_openai_seconds", "Duration of OpenAI requests", ("model", "kind")))
+command_timeouts = registry.register(
+    Counter("aibot_command_timeouts_total", "Commands stopped by timeout", ("command",))
+)
+handler_errors = registry.register(
+    Counter("aibot_handler_errors_total", "Errors raised by state handlers", ("handler", "state"))
+)
+cache_hits = registry.register(CounterFunc("aibot_cache_hits_total", "Cache hits", ("cache",)))
+cache_misses = registry.register(CounterFunc("aibot_cache_misses_total", "Cache misses", ("cache",)))
+cache_hit_rate = registry.register(GaugeFunc("aibot_cache_hit_rate", "Cache hit rate", ("cache",)))
+
+
+# Кэш с методом get_stats(): hits, misses и hit_rate выгружаются при каждом запросе метрик
+def register_cache(name: str, get_stats: Callable[[], dict]):
+    cache_hits.add(lambda: {(name,): get_stats()["hits"]})
+    cache_misses.add(lambda: {(name,): get_stats()["misses"]})
+    cache_hit_rate.add(lambda: {(name,): get_stats()["hit_rate"]})
+
+
+# Замер длительности методов объекта, например отправки сообщений ботом
+def instrument_methods(obj, names: tuple, histogram: Histogram, *labels):
+    for name in names:
+        setattr(obj, name, histogram.timed(*labels)(getattr(obj, name)))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = registry.to_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Metrics server: http://%s:%s/metrics", host, port)
+    return server
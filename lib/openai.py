@@ -1,23 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import Optional
+import time
+from typing import Iterator, Optional, Union
 
-from openai import OpenAI
-import requests
+from openai import AsyncOpenAI, OpenAI
 
+from lib.aio import aio_loop
 from lib.config import Config
+from lib.dispatcher import bind_task, time_left
+from lib.history import HistoryManager
+from lib.http import Downloader
+from lib.metrics import openai_seconds
+
+
+image_downloader = Downloader(
+    Config.IMAGE_DOWNLOAD_POOL_SIZE, Config.IMAGE_DOWNLOAD_TIMEOUT, Config.IMAGE_MAX_BYTES, aio=aio_loop
+)
+image_executor = ThreadPoolExecutor(max_workers=Config.IMAGE_DOWNLOAD_POOL_SIZE, thread_name_prefix="image")
+
+
+# Запрос внутри задачи диспетчера ограничен оставшимся временем задачи, а не таймаутом клиента по умолчанию
+def with_timeout(kwargs: dict) -> dict:
+    timeout = time_left()
+    return kwargs if timeout is None else {**kwargs, "timeout": timeout}
 
 
 class DialogueAI:
-    def __init__(self, model: str = "gpt-3.5-turbo-1106"):
-        self.openai_client = OpenAI(api_key=Config.API_KEY_OPENAI, base_url=Config.OPENAI_URL)
+    def __init__(self, model: str = "gpt-3.5-turbo-1106", budgets: Optional[dict] = None):
+        # Синхронный и асинхронный клиенты с одинаковыми таймаутом и повторами
+        options = {
+            "api_key": Config.API_KEY_OPENAI,
+            "base_url": Config.OPENAI_URL,
+            "timeout": Config.OPENAI_TIMEOUT,
+            "max_retries": Config.OPENAI_RETRIES,
+        }
+        self.openai_client = OpenAI(**options)
+        self.openai_client_async = AsyncOpenAI(**options) if aio_loop else None
         self.model = model
         # Словарь для хранения истории разговора с каждым пользователем
         self.conversation_histories = {}
         self.conversation_default = {}
         self.user_model = {}
+        self.budgets = budgets
+        summarize = self._summarize if Config.HISTORY_SUMMARIZE else None
+        self.history = HistoryManager(budgets, summarize=summarize)
 
     def __deepcopy__(self, memo):
-        new_obj = DialogueAI(self.model)
+        new_obj = DialogueAI(self.model, self.budgets)
         data = {key: getattr(self, key) for key in ["conversation_histories", "conversation_default", "user_model"]}
         new_obj.init(data)
         memo[id(self)] = new_obj
@@ -30,11 +59,20 @@ class DialogueAI:
                 if name in val:
                     obj_dict[user_id] = val[name]
 
-    def to_dict(self) -> dict:
+    def unload_user(self, user_id: str):
+        for name in ["conversation_histories", "conversation_default", "user_model"]:
+            getattr(self, name).pop(user_id, None)
+
+    def to_dict(self, user_ids: Optional[set] = None) -> dict:
         data = {}
         for name in ["conversation_histories", "conversation_default", "user_model"]:
+            # Копия элементов: истории дополняются в потоках обработчиков во время сохранения
             obj_dict = getattr(self, name)
-            for user_id, val in obj_dict.items():
+            for user_id, val in list(obj_dict.items()):
+                if user_ids is not None and user_id not in user_ids:
+                    continue
+                if isinstance(val, list):
+                    val = list(val)
                 if user_id in data:
                     data[user_id].update({name: val})
                 else:
@@ -72,26 +110,92 @@ class DialogueAI:
         message = self.get_system(user_id)
         self.add_message(user_id, "system", message["content"])
 
-    def _generate_image(self, current_model: str, prompt: str) -> (str, Optional[BytesIO]):
-        response = self.openai_client.images.generate(model=current_model, prompt=prompt, n=1, size="1024x1024")
+    def trim_history(self, user_id: str):
+        self.history.trim(self.conversation_histories[user_id], self.get_model(user_id))
+
+    def _summarize(self, messages: list, current_model: str) -> str:
+        dialogue_text = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        prompt = [
+            {"role": "system", "content": "Кратко перескажи диалог, сохранив важные факты и договорённости."},
+            {"role": "user", "content": dialogue_text},
+        ]
+        return self._generate_text(current_model, prompt)
+
+    # Изображение возвращается ссылкой для отправки в Telegram напрямую или загружается через бота
+    def _generate_one_image(self, kwargs: dict) -> (str, Union[str, BytesIO]):
+        kwargs = with_timeout(kwargs)
+        with openai_seconds.time(kwargs["model"], "image"):
+            if self.openai_client_async:
+                response = aio_loop.run(self.openai_client_async.images.generate(**kwargs))
+            else:
+                response = self.openai_client.images.generate(**kwargs)
         ai_response_content = response.data[0].revised_prompt
         image_url = response.data[0].url
-        image_response = requests.get(image_url)
-        image_bytes = BytesIO(image_response.content)
-        return ai_response_content, image_bytes
+        if Config.IMAGE_DELIVERY == "url":
+            return ai_response_content, image_url
+        return ai_response_content, image_downloader.get(image_url)
+
+    # DALL-E 3 генерирует одно изображение за запрос, поэтому несколько изображений
+    # запрашиваются и загружаются параллельно
+    def _generate_image(
+        self, current_model: str, prompt: str, size: str = "1024x1024", quality: str = "standard", count: int = 1
+    ) -> (str, list):
+        kwargs = {"model": current_model, "prompt": prompt, "n": 1, "size": size, "quality": quality}
+        if count <= 1:
+            results = [self._generate_one_image(kwargs)]
+        else:
+            results = list(image_executor.map(bind_task(self._generate_one_image), [kwargs] * count))
+        ai_response_content = results[0][0]
+        return ai_response_content, [image for _, image in results]
 
     def _generate_text(self, current_model: str, conversation_history: list) -> str:
-        chat_completion = self.openai_client.chat.completions.create(model=current_model, messages=conversation_history)
+        kwargs = with_timeout({"model": current_model, "messages": conversation_history})
+        with openai_seconds.time(current_model, "text"):
+            if self.openai_client_async:
+                chat_completion = aio_loop.run(self.openai_client_async.chat.completions.create(**kwargs))
+            else:
+                chat_completion = self.openai_client.chat.completions.create(**kwargs)
         ai_response_content = chat_completion.choices[0].message.content
         return ai_response_content
 
-    def generate(self, user_id: str, user_input: str) -> (str, Optional[BytesIO]):
+    def _generate_text_stream(self, current_model: str, conversation_history: list) -> Iterator[str]:
+        kwargs = with_timeout({"model": current_model, "messages": conversation_history, "stream": True})
+        started = time.perf_counter()
+        if self.openai_client_async:
+            stream = aio_loop.run(self.openai_client_async.chat.completions.create(**kwargs))
+            chunks = aio_loop.iterate(stream)
+        else:
+            chunks = self.openai_client.chat.completions.create(**kwargs)
+        # Время до первого фрагмента ответа и до конца генерации
+        first = True
+        try:
+            for chunk in chunks:
+                if first:
+                    openai_seconds.observe(time.perf_counter() - started, current_model, "stream_first")
+                    first = False
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            openai_seconds.observe(time.perf_counter() - started, current_model, "stream")
+
+    def is_image_model(self, user_id: str) -> bool:
+        return self.get_model(user_id) in ["dall-e-3"]
+
+    def generate_stream(self, user_id: str, user_input: str) -> Iterator[str]:
+        self.add_message(user_id, "user", user_input)
+        self.trim_history(user_id)
+        conversation_history = self.conversation_histories[user_id]
+        current_model = self.get_model(user_id)
+        yield from self._generate_text_stream(current_model, conversation_history)
+
+    def generate(self, user_id: str, user_input: str, image_options: Optional[dict] = None) -> (str, list):
         self.add_message(user_id, "user", user_input)
+        self.trim_history(user_id)
         conversation_history = self.conversation_histories[user_id]
         current_model = self.get_model(user_id)
-        image_bytes = None
-        if current_model in ["dall-e-3"]:
-            ai_response_content, image_bytes = self._generate_image(current_model, user_input)
+        images = []
+        if self.is_image_model(user_id):
+            ai_response_content, images = self._generate_image(current_model, user_input, **(image_options or {}))
         else:
             ai_response_content = self._generate_text(current_model, conversation_history)
-        return ai_response_content, image_bytes
+        return ai_response_content, images
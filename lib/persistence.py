@@ -0,0 +1,163 @@
+from collections import defaultdict
+from datetime import datetime
+import logging
+import threading
+import time
+from typing import Any, Callable, Hashable, Optional
+
+from lib.cache import StatsMixin
+
+
+logger = logging.getLogger(__name__)
+
+
+# Периодическое сохранение только тех пользователей, чьё состояние менялось
+class AutoSaver(StatsMixin):
+    def __init__(self, save_func: Callable[[Optional[set]], int], interval: float = 60.0):
+        # save_func принимает множество ID пользователей (None - все) и возвращает число записанных байт
+        self.save_func = save_func
+        self.interval = interval
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._tasks = []
+        self._stats = {
+            "flushes": 0,
+            "errors": 0,
+            "last_latency": 0.0,
+            "max_latency": 0.0,
+            "last_batch": 0,
+            "last_bytes": 0,
+            "bytes_total": 0,
+        }
+
+    def mark_dirty(self, user_id: Hashable):
+        with self._lock:
+            self._dirty.add(user_id)
+
+    def is_dirty(self, user_id: Hashable) -> bool:
+        with self._lock:
+            return user_id in self._dirty
+
+    def dirty_count(self) -> int:
+        with self._lock:
+            return len(self._dirty)
+
+    # Дополнительная периодическая задача, выполняется после каждого сохранения
+    def add_task(self, func: Callable[[], Any]):
+        self._tasks.append(func)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="autosaver", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def flush(self, full: bool = False, user_ids: Optional[set] = None) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch = set(self._dirty) if user_ids is None else self._dirty & set(user_ids)
+                self._dirty -= batch
+            if not batch and not full:
+                return 0
+            started = time.monotonic()
+            try:
+                written = self.save_func(None if full else batch)
+            except Exception:
+                with self._lock:
+                    self._dirty |= batch
+                    self._stats["errors"] += 1
+                raise
+            latency = time.monotonic() - started
+            with self._lock:
+                self._stats["flushes"] += 1
+                self._stats["last_latency"] = latency
+                self._stats["max_latency"] = max(self._stats["max_latency"], latency)
+                self._stats["last_batch"] = len(batch)
+                self._stats["last_bytes"] = written
+                self._stats["bytes_total"] += written
+            logger.info("Autosave: users %s, bytes %s, %.3f s", "all" if full else len(batch), written, latency)
+            return written
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["dirty"] = len(self._dirty)
+        return stats
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as ex:
+                logger.error("Autosave error: %s", ex)
+            for func in self._tasks:
+                try:
+                    func()
+                except Exception as ex:
+                    logger.error("Autosave task error: %s", ex)
+
+
+# Словарь состояний пользователей: замена состояния помечает пользователя изменённым,
+# изменения внутри состояния отмечаются через saver.mark_dirty() обработчиком сообщения
+class TrackedDict(defaultdict):
+    def __init__(self, default_factory: Callable, saver: AutoSaver):
+        super().__init__(default_factory)
+        self.saver = saver
+        self._lock = threading.RLock()
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+        self.saver.mark_dirty(key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+
+    def pop(self, key, *args):
+        with self._lock:
+            return super().pop(key, *args)
+
+    # Копия словаря для сохранения, пока другие потоки добавляют и удаляют пользователей
+    def snapshot(self, keys: Optional[set] = None) -> dict:
+        with self._lock:
+            if keys is None:
+                return dict(self)
+            return {key: dict.__getitem__(self, key) for key in keys if dict.__contains__(self, key)}
+
+
+# Словарь состояний с загрузкой пользователя из хранилища при первом обращении.
+# Если в хранилище пользователя нет, создаётся состояние по умолчанию.
+# Время загрузки или создания состояния хранится в loaded_at
+class LazyDict(TrackedDict):
+    def __init__(self, default_factory: Callable, saver: AutoSaver, loader: Callable[[Hashable], Any]):
+        super().__init__(default_factory, saver)
+        self.loader = loader
+        self.loaded_at = {}
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self.loaded_at[key] = datetime.now()
+
+    def pop(self, key, *args):
+        with self._lock:
+            self.loaded_at.pop(key, None)
+            return super().pop(key, *args)
+
+    def __missing__(self, key):
+        with self._lock:
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+            value = self.loader(key)
+            if value is None:
+                value = self.default_factory()
+            dict.__setitem__(self, key, value)
+            self.loaded_at[key] = datetime.now()
+            return value
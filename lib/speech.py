@@ -1,13 +1,25 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 from io import BytesIO
 import logging
-from typing import Optional, Union
+import re
+import subprocess
+import threading
+import time
+from typing import Iterable, Iterator, Optional, Sequence, Union
 
 from gtts import gTTS
+from pydub import AudioSegment
 from speechkit import configure_credentials, creds, model_repository
 from speechkit.stt import AudioProcessingType
 
+from lib.cache import FileCache, LRUCache, StatsMixin, TieredCache
 from lib.config import Config
+from lib.detect import detect_local
+from lib.dispatcher import bind_task, time_left
 from lib.enum import BaseEnum
+from lib.metrics import stage_seconds
 
 
 logger = logging.getLogger(__name__)
@@ -59,15 +71,191 @@ class SpeechLang(BaseEnum):
     UZ = "uz-UZ"  # Узбекский (латиница)
 
 
+# Параметры кодирования аудио для pydub: формат -> аргументы export
+AUDIO_CODECS = {
+    "ogg": {"format": "ogg", "codec": "libopus", "parameters": ["-ac", "1"]},
+    "mp3": {"format": "mp3"},
+    "wav": {"format": "wav"},
+}
+
+
+def encode_audio(segment: AudioSegment, audio_format: str = "ogg", bitrate: Optional[str] = None) -> bytes:
+    params = dict(AUDIO_CODECS[audio_format])
+    if bitrate and audio_format != "wav":
+        params["bitrate"] = bitrate
+    audio_stream = BytesIO()
+    segment.export(audio_stream, **params)
+    return audio_stream.getvalue()
+
+
+# Сравнение форматов: время кодирования и размер относительно WAV
+def benchmark_codecs(segment: AudioSegment, variants: list[tuple], repeat: int = 3) -> list[dict]:
+    wav_size = len(encode_audio(segment, "wav"))
+    results = []
+    for audio_format, bitrate in variants:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            data = encode_audio(segment, audio_format, bitrate)
+        encode_time = (time.perf_counter() - started) / repeat
+        results.append(
+            {
+                "format": audio_format,
+                "bitrate": bitrate,
+                "bytes": len(data),
+                "saved_bytes": wav_size - len(data),
+                "ratio": wav_size / len(data),
+                "encode_ms": encode_time * 1000,
+            }
+        )
+    return results
+
+
+# Разбивает текст на части не длиннее limit по границам предложений, а длинные предложения - по словам
+def split_sentences(text: str, limit: int) -> list[str]:
+    sentences = [item.strip() for item in re.split(r"(?<=[.!?…;])\s+|\n+", text) if item.strip()]
+    chunks = []
+    chunk = ""
+    for sentence in sentences:
+        while len(sentence) > limit:
+            pos = sentence.rfind(" ", 0, limit)
+            pos = pos if pos > 0 else limit
+            if chunk:
+                chunks.append(chunk)
+                chunk = ""
+            chunks.append(sentence[:pos].strip())
+            sentence = sentence[pos:].strip()
+        if chunk and len(chunk) + len(sentence) + 1 > limit:
+            chunks.append(chunk)
+            chunk = ""
+        chunk = f"{chunk} {sentence}" if chunk else sentence
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+# Сколько ждать поток записи в ffmpeg после остановки декодирования
+FEED_JOIN_TIMEOUT = 1.0
+
+
+# Потоковое декодирование записи через ffmpeg: данные подаются по частям, PCM читается блоками по chunk_ms,
+# поэтому запись целиком не хранится в памяти ни в сжатом, ни в декодированном виде
+def decode_audio_stream(
+    chunks: Iterable[bytes], chunk_ms: int = 1000, sample_rate: int = 16000
+) -> Iterator[AudioSegment]:
+    command = [AudioSegment.converter, "-loglevel", "error", "-i", "pipe:0"]
+    command += ["-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    errors = []
+
+    # Запись в ffmpeg в отдельном потоке, чтобы чтение и запись через каналы не блокировали друг друга
+    def feed():
+        try:
+            for data in chunks:
+                process.stdin.write(data)
+        except BrokenPipeError:
+            pass
+        except Exception as ex:
+            errors.append(ex)
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, name="ffmpeg-feed", daemon=True)
+    feeder.start()
+    chunk_bytes = sample_rate * 2 * chunk_ms // 1000
+    try:
+        while data := process.stdout.read(chunk_bytes):
+            yield AudioSegment(data=data, sample_width=2, frame_rate=sample_rate, channels=1)
+        # ffmpeg закрыл вывод, когда дочитал вход: запись к этому моменту закончена
+        feeder.join()
+        if errors:
+            raise errors[0]
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with code {process.returncode}")
+    finally:
+        # Потребитель мог остановиться раньше: прерываем загрузку и ffmpeg, чтобы поток записи
+        # не ждал следующей части из сети, и ждём его ограниченное время
+        if hasattr(chunks, "abort"):
+            chunks.abort()
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        feeder.join(FEED_JOIN_TIMEOUT)
+
+
+# Разбивает поток записи на окна около window_ms, граница окна сдвигается на самый тихий участок перед ней.
+# В памяти держится только текущее окно
+def split_audio(
+    chunks: Iterable[AudioSegment], window_ms: int, search_ms: int = 2000, step_ms: int = 50
+) -> Iterator[AudioSegment]:
+    buffer = None
+    for chunk in chunks:
+        buffer = chunk if buffer is None else buffer + chunk
+        while len(buffer) > window_ms:
+            positions = range(max(step_ms, window_ms - search_ms), window_ms, step_ms)
+            end = min(positions, key=lambda pos: buffer[pos : pos + step_ms].rms, default=window_ms)
+            yield buffer[:end]
+            buffer = buffer[end:]
+    if buffer is not None and len(buffer):
+        yield buffer
+
+
+# Кэш синтезированной речи: LRU в памяти и ограниченный по размеру каталог на диске
+class AudioCache(TieredCache):
+    def __init__(self, maxsize: int = 128, directory: Optional[str] = None, max_bytes: int = 0):
+        super().__init__(LRUCache(maxsize), FileCache(directory, max_bytes) if directory and max_bytes else None)
+
+
+# Общий реестр моделей SpeechKit: модель настраивается один раз при создании
+# и дальше не изменяется, поэтому её можно использовать из разных потоков
+class SpeechModelPool(StatsMixin):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._synthesis = {}
+        self._recognition = {}
+
+    def synthesis(self, voice: str):
+        model = self._synthesis.get(voice)
+        if model is None:
+            with self._lock:
+                model = self._synthesis.get(voice)
+                if model is None:
+                    model = model_repository.synthesis_model()
+                    model.voice = voice
+                    self._synthesis[voice] = model
+        return model
+
+    def recognition(self, lang: str, model_name: str = "general"):
+        key = (lang, model_name)
+        model = self._recognition.get(key)
+        if model is None:
+            with self._lock:
+                model = self._recognition.get(key)
+                if model is None:
+                    model = model_repository.recognition_model()
+                    model.model = model_name
+                    model.language = lang
+                    model.audio_processing_type = AudioProcessingType.Full
+                    self._recognition[key] = model
+        return model
+
+    def get_stats(self) -> dict:
+        return {"synthesis": len(self._synthesis), "recognition": len(self._recognition)}
+
+
+speech_models = SpeechModelPool()
+audio_cache = AudioCache(Config.AUDIO_CACHE_SIZE, Config.AUDIO_CACHE_DIR, Config.AUDIO_CACHE_DISK_BYTES)
+speech_executor = ThreadPoolExecutor(max_workers=Config.SPEECH_WORKERS, thread_name_prefix="speech")
+
+
+# Настройки речи пользователя: голос и язык, модели берутся из общего реестра в момент вызова
 class Speech:
     def __init__(self, voice: str, lang: str = "auto"):
-        self.audio_stream = BytesIO()
         self.voice = voice
         self.lang = lang
-        self.model_synthesis = None
-        self.model_recognition = None
-        self.set_synthesis(voice)
-        self.set_recognition(lang)
 
     def __deepcopy__(self, memo):
         new_obj = Speech(self.voice, self.lang)
@@ -78,10 +266,8 @@ class Speech:
         voice = data.get("voice")
         lang = data.get("lang")
         if voice:
-            self.voice = voice
             self.set_synthesis(voice)
         if lang:
-            self.lang = lang
             self.set_recognition(lang)
 
     def to_dict(self) -> dict:
@@ -95,32 +281,72 @@ class Speech:
     def is_google(self) -> bool:
         return self.voice == SpeechVoice.GOOGLE
 
+    @property
+    def model_synthesis(self):
+        return None if self.is_google() else speech_models.synthesis(self.voice)
+
+    @property
+    def model_recognition(self):
+        return speech_models.recognition(self.lang)
+
     def set_synthesis(self, voice: str):
         self.voice = voice
-        if not self.is_google():
-            if self.model_synthesis is None:
-                self.model_synthesis = model_repository.synthesis_model()
-            self.model_synthesis.voice = voice
-            # self.model_synthesis.role = "neutral"
 
     def set_recognition(self, lang: str = "auto"):
         self.lang = lang
-        if self.model_recognition is None:
-            self.model_recognition = model_repository.recognition_model()
-        self.model_recognition.model = "general"
-        self.model_recognition.language = lang
-        self.model_recognition.audio_processing_type = AudioProcessingType.Full
 
-    def synthesize(self, text: str) -> BytesIO:
-        self.audio_stream = BytesIO()
+    # Ключ кэша синтеза: движок, голос, язык и хэш текста
+    def get_audio_key(self, text: str) -> str:
+        engine = "google" if self.is_google() else "speechkit"
+        codec = f"{Config.SPEECH_FORMAT}{Config.SPEECH_BITRATE or ''}"
+        digest = hashlib.sha1(text.encode()).hexdigest()
+        return f"{engine}-{self.voice}-{self.lang}-{codec}-{digest}"
+
+    @stage_seconds.timed("tts")
+    def synthesize_segment(self, text: str) -> AudioSegment:
         if not self.is_google():
-            result = self.model_synthesis.synthesize(text, raw_format=False)
-            result.export(self.audio_stream, format="wav")
+            return self.model_synthesis.synthesize(text, raw_format=False)
+        audio_stream = BytesIO()
+        tts = gTTS(text, lang=self.lang2, timeout=time_left())
+        tts.write_to_fp(audio_stream)
+        audio_stream.seek(0)
+        return AudioSegment.from_file(audio_stream, format="mp3")
+
+    def _synthesize(self, text: str) -> bytes:
+        return encode_audio(self.synthesize_segment(text), Config.SPEECH_FORMAT, Config.SPEECH_BITRATE)
+
+    def _synthesize_cached(self, text: str) -> bytes:
+        key = self.get_audio_key(text)
+        data = audio_cache.get(key)
+        if data is None:
+            data = self._synthesize(text)
+            audio_cache.set(key, data)
+        return data
+
+    # Синтез длинного текста: части синтезируются параллельно и склеиваются по порядку
+    def synthesize(self, text: str) -> BytesIO:
+        chunks = split_sentences(text, Config.SPEECH_CHUNK_SIZE)
+        if len(chunks) <= 1:
+            data = self._synthesize_cached(text)
         else:
-            tts = gTTS(text, lang=self.lang2)
-            tts.write_to_fp(self.audio_stream)
-        self.audio_stream.seek(0)
-        return self.audio_stream
+            key = self.get_audio_key(text)
+            data = audio_cache.get(key)
+            if data is None:
+                segments = list(speech_executor.map(bind_task(self.synthesize_segment), chunks))
+                data = encode_audio(sum(segments[1:], segments[0]), Config.SPEECH_FORMAT, Config.SPEECH_BITRATE)
+                audio_cache.set(key, data)
+        return BytesIO(data)
+
+    # Синтез длинного текста по частям: первая часть отдаётся, как только готова
+    def synthesize_chunks(self, text: str) -> Iterator[BytesIO]:
+        chunks = split_sentences(text, Config.SPEECH_CHUNK_SIZE) or [text]
+        futures = [speech_executor.submit(bind_task(self._synthesize_cached), chunk) for chunk in chunks]
+        try:
+            for future in futures:
+                yield BytesIO(future.result())
+        finally:
+            for future in futures:
+                future.cancel()
 
     @staticmethod
     def _recognize_log(result: list, detail: bool = False) -> str:
@@ -139,12 +365,32 @@ class Speech:
                 lines += [f"channel: {c}", " ".join(utterances) if utterances else normalized_text]
         return "\n".join(lines) if detail else " ".join(lines)
 
+    @stage_seconds.timed("stt")
     def recognize(self, audio_bytes: bytes) -> str:
         result = self.model_recognition.transcribe(audio_bytes)
         logger.info("Recognize text: %s", self._recognize_log(result))
         text = "\n".join([res.normalized_text for res in result])
         return text
 
+    def recognize_segment(self, segment: AudioSegment) -> str:
+        return self.recognize(encode_audio(segment, "ogg"))
+
+    # Распознавание длинной записи по окнам по мере скачивания и декодирования: окна распознаются параллельно,
+    # текст каждого окна отдаётся по порядку, как только он готов
+    def recognize_stream(self, chunks: Iterable[bytes], window: float) -> Iterator[str]:
+        futures = deque()
+        try:
+            for item in split_audio(decode_audio_stream(chunks), int(window * 1000)):
+                futures.append(speech_executor.submit(bind_task(self.recognize_segment), item))
+                # Не больше окон в работе, чем потоков распознавания: декодирование ждёт распознавания
+                while futures and (futures[0].done() or len(futures) > Config.SPEECH_WORKERS):
+                    yield futures.popleft().result().strip()
+            while futures:
+                yield futures.popleft().result().strip()
+        finally:
+            for future in futures:
+                future.cancel()
+
     @staticmethod
     def choce_from_lang(lst: Union[tuple, list], lang: str) -> Optional["Speech"]:
         def _get_item(lst, value, split):
@@ -169,3 +415,56 @@ class Speech:
     @staticmethod
     def get_langs2(lst: Union[tuple, list]) -> list[str]:
         return [item.lang2 for item in lst]
+
+
+# Распознавание одной записи всеми распознавателями пользователя параллельно.
+# Язык записи определяется по тексту распознавателя auto среди языков пользователя: если он определён,
+# выбирается результат распознавателя этого языка, иначе результат auto. Без auto выбираются результаты,
+# язык которых совпадает с языком распознавателя, среди них - самый длинный
+def recognize_fanout(speeches: Sequence[Speech], audio_bytes: bytes) -> tuple[str, Speech]:
+    futures = {speech_executor.submit(bind_task(speech.recognize), audio_bytes): speech for speech in speeches}
+    results = {}
+    error = None
+    try:
+        for future in as_completed(futures):
+            speech = futures[future]
+            try:
+                results[speech] = future.result().strip()
+            except Exception as ex:
+                logger.warning("Recognize error, lang %s: %s", speech.lang, ex)
+                error = ex
+                continue
+            winner = _fanout_winner(speeches, results, len(results) == len(futures))
+            if winner is not None:
+                logger.info("Recognize fan-out: %s wins", winner.lang)
+                return results[winner], winner
+    finally:
+        # Снимаются только ещё не начатые распознавания: начатый запрос к SpeechKit прервать нельзя,
+        # он завершится в фоне, а его результат будет отброшен
+        for future in futures:
+            future.cancel()
+    if not results:
+        raise error
+    winner = _fanout_winner(speeches, results, True) or max(results, key=lambda item: len(results[item]))
+    return results[winner], winner
+
+
+# Выбор результата параллельного распознавания; None - нужно дождаться остальных распознавателей
+def _fanout_winner(speeches: Sequence[Speech], results: dict, is_final: bool) -> Optional[Speech]:
+    hints = [speech.lang2 for speech in speeches if speech.lang != "auto"]
+    auto = next((speech for speech in speeches if speech.lang == "auto"), None)
+    if auto is not None:
+        if not results.get(auto):
+            return None
+        lang = detect_local(results[auto], hints)
+        target = next((speech for speech in speeches if speech.lang != "auto" and speech.lang2 == lang), None)
+        if target is not None and results.get(target):
+            return target
+        # Язык записи не из языков пользователя или не определён: результат auto
+        if target is None or is_final:
+            return auto
+        return None
+    if not is_final:
+        return None
+    consistent = [speech for speech, text in results.items() if text and detect_local(text, hints) == speech.lang2]
+    return max(consistent, key=lambda speech: len(results[speech])) if consistent else None
@@ -1,9 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import re
 from typing import Optional
 
-import requests
-
+from lib.aio import aio_loop
+from lib.cache import LRUCache, SQLiteCache, TieredCache
 from lib.config import Config
+from lib.detect import LanguageDetector
+from lib.dispatcher import bind_task, time_left
 from lib.helpers import get_lang2
+from lib.http import create_session
+from lib.metrics import stage_seconds
+
+
+# Кэш переводов: LRU в памяти и необязательный постоянный уровень на диске
+class TranslationCache(TieredCache):
+    def __init__(self, maxsize: int = 2048, file_path: Optional[str] = None, disk_maxsize: Optional[int] = None):
+        super().__init__(LRUCache(maxsize), SQLiteCache(file_path, "translations", disk_maxsize) if file_path else None)
+
+    @staticmethod
+    def get_key(text: str, lang_to: str, lang_from: Optional[str] = None) -> str:
+        normalized = re.sub(r"[ \t]+", " ", text.strip())
+        digest = hashlib.sha1(normalized.encode()).hexdigest()
+        return f"{lang_from or 'auto'}:{lang_to}:{digest}"
+
+
+# Общая для всех пользователей сессия с пулом соединений к Yandex Translate
+translate_session = create_session(Config.TRANSLATE_POOL_SIZE, Config.TRANSLATE_RETRIES)
+language_detector = LanguageDetector(Config.DETECT_CACHE_SIZE, Config.DETECT_CACHE_TTL)
+translate_executor = ThreadPoolExecutor(max_workers=Config.TRANSLATE_POOL_SIZE, thread_name_prefix="translate")
+translation_cache = TranslationCache(
+    Config.TRANSLATE_CACHE_SIZE, Config.TRANSLATE_CACHE_FILE, Config.TRANSLATE_CACHE_DISK_SIZE
+)
 
 
 class Translate:
@@ -19,32 +47,119 @@ class Translate:
                 return
             self.language_code_hints.append(get_lang2(item))
 
+    @staticmethod
+    def _post(url: str, data: dict) -> Optional[dict]:
+        headers = {"Authorization": f"Api-Key {Config.API_KEY_YANDEX_TTS}", "Content-Type": "application/json"}
+        read_timeout = time_left(Config.TRANSLATE_TIMEOUT)
+        if aio_loop:
+            return aio_loop.run(
+                aio_loop.post_json(
+                    url, headers, data, read_timeout, Config.TRANSLATE_CONNECT_TIMEOUT, Config.TRANSLATE_RETRIES
+                )
+            )
+        timeout = (Config.TRANSLATE_CONNECT_TIMEOUT, read_timeout)
+        response = translate_session.post(url, headers=headers, json=data, timeout=timeout)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            return None
+
     def detect_language(self, text: str) -> Optional[str]:
+        return language_detector.detect(text, self.language_code_hints, self._detect_language_remote)
+
+    @stage_seconds.timed("detect")
+    def _detect_language_remote(self, text: str) -> Optional[str]:
         url = "https://translate.api.cloud.yandex.net/translate/v2/detect"
-        headers = {"Authorization": f"Api-Key {Config.API_KEY_YANDEX_TTS}", "Content-Type": "application/json"}
         data = {"text": text}
         if self.folder_id:
             data["folderId"] = self.folder_id
         if self.language_code_hints:
             data["language_code_hints"] = self.language_code_hints
-        response = requests.post(url, headers=headers, json=data)
-        if response.status_code == 200:
-            language = response.json()["languageCode"]
+        json_response = self._post(url, data)
+        if json_response is not None:
+            language = json_response["languageCode"]
             return language
         else:
             return None
 
     def translate(self, text: str, lang_to: str, lang_from: Optional[str] = None) -> Optional[str]:
+        key = translation_cache.get_key(text, lang_to, lang_from)
+        result = translation_cache.get(key)
+        if result is None:
+            result = self._translate_remote([text], lang_to, lang_from)[0]
+            if result is not None:
+                translation_cache.set(key, result)
+        return result
+
+    def translate_many(self, texts: list[str], lang_to: str, lang_from: Optional[str] = None) -> list[Optional[str]]:
+        results = [None] * len(texts)
+        missing = {}
+        for idx, text in enumerate(texts):
+            if not text.strip():
+                results[idx] = text
+                continue
+            key = translation_cache.get_key(text, lang_to, lang_from)
+            result = translation_cache.get(key)
+            if result is None:
+                missing.setdefault(key, []).append(idx)
+            else:
+                results[idx] = result
+        if not missing:
+            return results
+
+        # Уникальные тексты упаковываются в запросы, пакеты отправляются параллельно
+        keys = list(missing)
+        packs = self._pack([texts[missing[key][0]] for key in keys], Config.TRANSLATE_BATCH_CHARS)
+        batches = [[texts[missing[keys[pos]][0]] for pos in pack] for pack in packs]
+        if len(batches) == 1:
+            translations = [self._translate_remote(batches[0], lang_to, lang_from)]
+        else:
+            translate_batch = lambda batch: self._translate_remote(batch, lang_to, lang_from)
+            translations = translate_executor.map(bind_task(translate_batch), batches)
+        for pack, pack_translations in zip(packs, translations):
+            for pos, result in zip(pack, pack_translations):
+                if result is None:
+                    continue
+                translation_cache.set(keys[pos], result)
+                for idx in missing[keys[pos]]:
+                    results[idx] = result
+        return results
+
+    def translate_paragraphs(self, text: str, lang_to: str, lang_from: Optional[str] = None) -> Optional[str]:
+        parts = re.split(r"(\n\s*\n)", text)
+        if len(parts) == 1:
+            return self.translate(text, lang_to, lang_from)
+        translations = self.translate_many(parts[0::2], lang_to, lang_from)
+        if None in translations:
+            return None
+        parts[0::2] = translations
+        return "".join(parts)
+
+    # Разбивает тексты на пакеты с суммарной длиной не больше limit, возвращает индексы текстов
+    @staticmethod
+    def _pack(texts: list[str], limit: int) -> list[list[int]]:
+        packs = []
+        pack, size = [], 0
+        for idx, text in enumerate(texts):
+            if pack and size + len(text) > limit:
+                packs.append(pack)
+                pack, size = [], 0
+            pack.append(idx)
+            size += len(text)
+        if pack:
+            packs.append(pack)
+        return packs
+
+    @stage_seconds.timed("translate")
+    def _translate_remote(self, texts: list[str], lang_to: str, lang_from: Optional[str] = None) -> list[Optional[str]]:
         url = "https://translate.api.cloud.yandex.net/translate/v2/translate"
-        headers = {"Authorization": f"Api-Key {Config.API_KEY_YANDEX_TTS}", "Content-Type": "application/json"}
-        data = {"texts": [text], "targetLanguageCode": lang_to}
+        data = {"texts": texts, "targetLanguageCode": lang_to}
         if self.folder_id:
             data["folderId"] = self.folder_id
         if lang_from:
             data["sourceLanguageCode"] = lang_from
-        response = requests.post(url, headers=headers, json=data)
-        if response.status_code == 200:
-            json_response = response.json()
-            return json_response["translations"][0]["text"]
+        json_response = self._post(url, data)
+        if json_response is not None:
+            return [item["text"] for item in json_response["translations"]]
         else:
-            return None
+            return [None] * len(texts)
@@ -1,7 +1,17 @@
+from contextlib import contextmanager
 import copy
 from datetime import datetime
 import json
-from typing import Any, Dict, Union
+import logging
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, Optional, Union
+
+from lib.history_log import HistoryLog
+
+
+logger = logging.getLogger(__name__)
 
 
 # Конвертирует объект в строку
@@ -27,6 +37,27 @@ def json_to_object_hook(json_dict: Dict[str, Any]) -> Dict[str, Any]:
     return json_dict
 
 
+# Разница сохранённой и новой истории диалога: history = history[:prefix] + вставленные сообщения
+# + последние keep сохранённых сообщений + дописанные сообщения. Возвращает (prefix, start, keep),
+# где start - позиция первого оставшегося сообщения в новой истории
+def diff_history(saved: list, history: list) -> (int, int, int):
+    prefix = 0
+    limit = min(len(saved), len(history))
+    while prefix < limit and saved[prefix] == history[prefix]:
+        prefix += 1
+    if prefix == len(saved):
+        return prefix, prefix, 0
+    # После сокращения истории остаётся конец сохранённой: ищем последнее сохранённое сообщение с конца
+    for end in range(len(history) - 1, prefix - 1, -1):
+        if history[end] != saved[-1]:
+            continue
+        keep = 1
+        while keep < len(saved) - prefix and end - keep >= prefix and saved[-1 - keep] == history[end - keep]:
+            keep += 1
+        return prefix, end - keep + 1, keep
+    return prefix, prefix, 0
+
+
 class UserStorage:
     def __init__(self, file_path: str):
         self.file_path: str = file_path
@@ -45,9 +76,17 @@ class UserStorage:
         except (FileNotFoundError, json.JSONDecodeError):
             return {}
 
-    def _save_users_to_file(self) -> None:
+    def _save_users_to_file(self) -> int:
+        data = json.dumps(self.users, indent=4, default=object_to_json)
         with open(self.file_path, "w") as file:
-            json.dump(self.users, file, indent=4, default=object_to_json)
+            file.write(data)
+        return len(data.encode())
+
+    @staticmethod
+    def _filter_users(data: dict, user_ids: Optional[set] = None) -> dict:
+        if user_ids is None:
+            return data
+        return {user_id: val for user_id, val in data.items() if user_id in user_ids}
 
     def add_user(self, user_id: Union[int, str], additional_params: dict = None, save: bool = True) -> None:
         user_id = str(user_id)
@@ -82,8 +121,8 @@ class UserStorage:
             for idx, item in enumerate(obj):
                 self.add_user(user_id, {names[idx]: item.to_dict()}, False)
 
-    def set_object(self, name: str, obj: Any) -> None:
-        for user_id, val in obj.to_dict().items():
+    def set_object(self, name: str, obj: Any, user_ids: Optional[set] = None) -> None:
+        for user_id, val in obj.to_dict(user_ids).items():
             self.add_user(user_id, {name: val}, False)
 
     def get_params(self, name: str, obj_default: Any) -> dict:
@@ -113,11 +152,442 @@ class UserStorage:
                 data[user_id] = val[name]
         obj.init(data)
 
-    def save_external(self, users_params: dict, users_speech: dict, dialogue: Any) -> None:
-        self.set_params("params", users_params)
-        self.set_params_tuple(("speech_1", "speech_2"), users_speech)
-        self.set_object("dialogue", dialogue)
-        self._save_users_to_file()
+    # Загрузка состояния одного пользователя при первом обращении к нему
+    def load_params(self, user_id: str, name: str, obj_default: Any) -> Optional[Any]:
+        obj = self.users.get(user_id, {})
+        if name not in obj:
+            return None
+        obj_new = copy.deepcopy(obj_default)
+        obj_new.init(obj[name])
+        return obj_new
+
+    def load_params_tuple(self, user_id: str, names: tuple, tuple_default: tuple) -> Optional[tuple]:
+        obj = self.users.get(user_id, {})
+        if not any(name in obj for name in names):
+            return None
+        tuple_new = copy.deepcopy(tuple_default)
+        for idx, item in enumerate(tuple_new):
+            if names[idx] in obj:
+                item.init(obj[names[idx]])
+        return tuple_new
+
+    def load_object(self, user_id: str, name: str, obj: Any) -> None:
+        val = self.users.get(user_id, {})
+        if name in val:
+            obj.init({user_id: val[name]})
+
+    def save_external(
+        self, users_params: dict, users_speech: dict, dialogue: Any, user_ids: Optional[set] = None
+    ) -> int:
+        self.set_params("params", self._filter_users(users_params, user_ids))
+        self.set_params_tuple(("speech_1", "speech_2"), self._filter_users(users_speech, user_ids))
+        self.set_object("dialogue", dialogue, user_ids)
+        return self._save_users_to_file()
+
+
+# Хранилище пользователей в SQLite: отдельные строки для каждого пользователя,
+# изменения записываются точечно, а не перезаписью всего файла
+class SQLiteUserStorage(UserStorage):
+    speech_names = ("speech_1", "speech_2")
+    schema = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS params (user_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS speech (
+            user_id TEXT NOT NULL, slot INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (user_id, slot)
+        );
+        CREATE TABLE IF NOT EXISTS dialogue (user_id TEXT PRIMARY KEY, system TEXT, model TEXT);
+        CREATE TABLE IF NOT EXISTS messages (
+            user_id TEXT NOT NULL, pos INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL,
+            PRIMARY KEY (user_id, pos)
+        );
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        json_path: Optional[str] = None,
+        history_log: Optional[HistoryLog] = None,
+        history_last: Optional[int] = None,
+    ):
+        self.json_path = json_path
+        # Журнал истории диалогов вместо таблицы messages и число последних сообщений, читаемых из него
+        self.history_log = history_log
+        self.history_last = history_last
+        self._lock = threading.RLock()
+        # Последние записанные значения: по ним определяется, что изменилось
+        self._written: dict = {}
+        self._messages: dict = {}
+        # Номера строк таблицы messages для сохранённых сообщений: по ним меняются только изменившиеся строки
+        self._positions: dict = {}
+        # Изменения текущей транзакции, переносятся в _written, _messages и _positions после фиксации
+        self._pending: Optional[dict] = None
+        self._pending_messages: dict = {}
+        self._bytes_written = 0
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(self.schema)
+        super().__init__(file_path)
+
+    @staticmethod
+    def _dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False, default=object_to_json)
+
+    @staticmethod
+    def _loads(data: str) -> Any:
+        return json.loads(data, object_hook=json_to_object_hook)
+
+    # Транзакция SQLite: записанные значения запоминаются только после успешной фиксации,
+    # иначе при следующем сохранении они будут записаны повторно
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            if self._pending is not None:
+                yield
+                return
+            self._pending, self._pending_messages = {}, {}
+            try:
+                with self.connection:
+                    yield
+                self._written.update(self._pending)
+                for user_id, (history, positions) in self._pending_messages.items():
+                    self._messages[user_id] = history
+                    self._positions[user_id] = positions
+            except Exception:
+                # Журнал истории пишется вне транзакции SQLite: после сбоя историю этих пользователей записываем заново
+                if self.history_log is not None:
+                    for user_id in self._pending_messages:
+                        self._messages.pop(user_id, None)
+                raise
+            finally:
+                self._pending, self._pending_messages = None, {}
+
+    def _load_users_from_file(self) -> dict:
+        with self._lock:
+            self._migrate_from_json()
+            users = {}
+            for user_id, data in self.connection.execute("SELECT user_id, data FROM users"):
+                users[user_id] = self._loads(data)
+                self._written[("users", user_id)] = data
+            return users
+
+    def _save_users_to_file(self) -> int:
+        with self._transaction():
+            start = self._bytes_written
+            for user_id, additional_params in self.users.items():
+                self._upsert_user(user_id, additional_params)
+            return self._bytes_written - start
+
+    def _migrate_from_json(self) -> None:
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'migrated_from_json'").fetchone()
+        if row or not self.json_path or not os.path.exists(self.json_path):
+            return
+        json_storage = UserStorage(self.json_path)
+        with self._transaction():
+            for user_id, obj in json_storage.users.items():
+                external = ("params", "dialogue", *self.speech_names)
+                profile = {key: val for key, val in obj.items() if key not in external}
+                self._upsert_user(user_id, profile)
+                if "params" in obj:
+                    self._upsert_params(user_id, obj["params"])
+                for slot, name in enumerate(self.speech_names):
+                    if name in obj:
+                        self._upsert_speech(user_id, slot, obj[name])
+                if "dialogue" in obj:
+                    self._upsert_dialogue(user_id, obj["dialogue"])
+            self.connection.execute("INSERT INTO meta (key, value) VALUES ('migrated_from_json', ?)", (self.json_path,))
+        logger.info("Migrated %s users from %s", len(json_storage.users), self.json_path)
+
+    def _is_changed(self, key: tuple, data: str) -> bool:
+        if self._pending.get(key, self._written.get(key)) == data:
+            return False
+        self._pending[key] = data
+        self._bytes_written += len(data.encode())
+        return True
+
+    def _upsert_user(self, user_id: str, additional_params: dict) -> None:
+        data = self._dumps(additional_params)
+        if self._is_changed(("users", user_id), data):
+            self.connection.execute(
+                "INSERT INTO users (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                (user_id, data),
+            )
+
+    def _upsert_params(self, user_id: str, params: dict) -> None:
+        data = self._dumps(params)
+        if self._is_changed(("params", user_id), data):
+            self.connection.execute(
+                "INSERT INTO params (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                (user_id, data),
+            )
+
+    def _upsert_speech(self, user_id: str, slot: int, speech: dict) -> None:
+        data = self._dumps(speech)
+        if self._is_changed(("speech", user_id, slot), data):
+            self.connection.execute(
+                "INSERT INTO speech (user_id, slot, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id, slot) DO UPDATE SET data = excluded.data",
+                (user_id, slot, data),
+            )
+
+    def _upsert_dialogue(self, user_id: str, dialogue: dict) -> None:
+        system = dialogue.get("conversation_default")
+        row = (self._dumps(system) if system else None, dialogue.get("user_model"))
+        if self._is_changed(("dialogue", user_id), self._dumps(row)):
+            self.connection.execute(
+                "INSERT INTO dialogue (user_id, system, model) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET system = excluded.system, model = excluded.model",
+                (user_id, *row),
+            )
+        if "conversation_histories" in dialogue:
+            self._save_messages(user_id, dialogue["conversation_histories"])
+
+    def _save_messages(self, user_id: str, history: list) -> None:
+        if self.history_log is not None:
+            self._save_messages_log(user_id, history)
+            return
+        saved, positions = self._pending_messages.get(user_id, (None, None))
+        if saved is None:
+            saved, positions = self._messages.get(user_id), self._positions.get(user_id)
+        rows = None
+        if saved is not None and positions is not None:
+            rows = self._diff_messages(user_id, saved, positions, history)
+        if rows is None:
+            # История не загружалась (например, после /start) или между строками нет места: записываем её заново
+            self.connection.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+            rows = [(user_id, pos, msg["role"], msg["content"]) for pos, msg in enumerate(history)]
+            positions = []
+        else:
+            rows, positions = rows
+        if rows:
+            self.connection.executemany("INSERT INTO messages (user_id, pos, role, content) VALUES (?, ?, ?, ?)", rows)
+            self._bytes_written += sum(len(row[3].encode()) for row in rows)
+        positions = sorted(positions + [row[1] for row in rows])
+        self._pending_messages[user_id] = (list(history), positions)
+
+    # Удаляет строки убранных сообщений и возвращает строки новых сообщений с номерами между оставшимися
+    # и номера оставшихся строк. None, если новые сообщения не помещаются между оставшимися строками
+    def _diff_messages(self, user_id: str, saved: list, positions: list, history: list) -> Optional[tuple]:
+        prefix, start, keep = diff_history(saved, history)
+        kept = positions[:prefix] + positions[len(saved) - keep :]
+        deleted = positions[prefix : len(saved) - keep]
+        inserted = history[prefix:start]
+        low = positions[prefix - 1] if prefix else -1
+        if keep and positions[len(saved) - keep] - low - 1 < len(inserted):
+            return None
+        if deleted:
+            self.connection.executemany(
+                "DELETE FROM messages WHERE user_id = ? AND pos = ?", [(user_id, pos) for pos in deleted]
+            )
+        rows = [(user_id, pos, msg["role"], msg["content"]) for pos, msg in enumerate(inserted, low + 1)]
+        last = positions[len(saved) - 1] if keep else low + len(inserted)
+        appended = history[start + keep :]
+        rows += [(user_id, pos, msg["role"], msg["content"]) for pos, msg in enumerate(appended, last + 1)]
+        return rows, kept
+
+    def _save_messages_log(self, user_id: str, history: list) -> None:
+        saved, _ = self._pending_messages.get(user_id, (self._messages.get(user_id), None))
+        if saved is not None and self.history_log.exists(user_id):
+            prefix, start, keep = diff_history(saved, history)
+            # Системное сообщение в начале загруженной истории могло быть добавлено при чтении, а не взято из журнала
+            if keep and keep == len(saved):
+                start, keep = start + 1, keep - 1
+            if prefix == len(saved):
+                if len(history) > prefix:
+                    self._bytes_written += self.history_log.append(user_id, history[prefix:])
+            else:
+                # История сокращена или резюмирована: в журнал дописывается правка, а не вся история
+                self._bytes_written += self.history_log.edit(user_id, history, start, keep)
+        else:
+            self._bytes_written += self.history_log.reset(user_id, history)
+            # История перенесена в журнал: строки таблицы messages больше не нужны
+            self.connection.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+        self._pending_messages[user_id] = (list(history), None)
+
+    # История пользователя: из журнала, если он есть, иначе из таблицы messages
+    def _load_messages(self, user_id: str, system: Optional[dict] = None) -> list:
+        if self.history_log is not None and self.history_log.exists(user_id):
+            history = self.history_log.read(user_id, self.history_last)
+            if system and history and history[0]["role"] != "system":
+                history.insert(0, system)
+            self._positions.pop(user_id, None)
+            return history
+        rows = self.connection.execute(
+            "SELECT pos, role, content FROM messages WHERE user_id = ? ORDER BY pos", (user_id,)
+        ).fetchall()
+        self._positions[user_id] = [pos for pos, _, _ in rows]
+        return [{"role": role, "content": content} for _, role, content in rows]
+
+    def _select_params(self, name: str) -> Iterable:
+        if name == "params":
+            return self.connection.execute("SELECT user_id, data FROM params").fetchall()
+        if name in self.speech_names:
+            slot = self.speech_names.index(name)
+            return self.connection.execute("SELECT user_id, data FROM speech WHERE slot = ?", (slot,)).fetchall()
+        return [(user_id, self._dumps(obj[name])) for user_id, obj in self.users.items() if name in obj]
+
+    def add_user(self, user_id: Union[int, str], additional_params: dict = None, save: bool = True) -> None:
+        with self._lock:
+            super().add_user(user_id, additional_params, False)
+            if save:
+                with self._transaction():
+                    self._upsert_user(str(user_id), self.users[str(user_id)])
+
+    def remove_user(self, user_id: int) -> None:
+        user_id = str(user_id)
+        with self._transaction():
+            self.users.pop(user_id, None)
+            self._messages.pop(user_id, None)
+            self._positions.pop(user_id, None)
+            self._written = {key: val for key, val in self._written.items() if key[1] != user_id}
+            for table in ("users", "params", "speech", "dialogue", "messages"):
+                self.connection.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+            if self.history_log is not None:
+                self.history_log.remove(user_id)
+
+    def set_params(self, name: str, data: dict) -> None:
+        with self._transaction():
+            for user_id, obj in data.items():
+                self._upsert_params(str(user_id), obj.to_dict())
+
+    def set_params_tuple(self, names: tuple, data: dict) -> None:
+        with self._transaction():
+            for user_id, obj in data.items():
+                for slot, item in enumerate(obj):
+                    self._upsert_speech(str(user_id), slot, item.to_dict())
+
+    def set_object(self, name: str, obj: Any, user_ids: Optional[set] = None) -> None:
+        with self._transaction():
+            for user_id, val in obj.to_dict(user_ids).items():
+                self._upsert_dialogue(str(user_id), val)
+
+    def get_params(self, name: str, obj_default: Any) -> dict:
+        data = {}
+        with self._lock:
+            rows = self._select_params(name)
+        for user_id, value in rows:
+            obj_new = copy.deepcopy(obj_default)
+            obj_new.init(self._loads(value))
+            data[user_id] = obj_new
+        return data
+
+    def get_params_tuple(self, names: tuple, tuple_default: tuple) -> dict:
+        with self._lock:
+            values = {name: dict(self._select_params(name)) for name in names}
+        data = {}
+        for user_id in self.users:
+            tuple_new = copy.deepcopy(tuple_default)
+            for idx, item in enumerate(tuple_new):
+                value = values[names[idx]].get(user_id)
+                if value is not None:
+                    item.init(self._loads(value))
+            data[user_id] = tuple_new
+        return data
+
+    def get_object(self, name: str, obj: Any) -> None:
+        data = {}
+        with self._lock:
+            for user_id, system, model in self.connection.execute("SELECT user_id, system, model FROM dialogue"):
+                val = {}
+                if system:
+                    val["conversation_default"] = self._loads(system)
+                if model:
+                    val["user_model"] = model
+                data[user_id] = val
+            if self.history_log is not None:
+                user_ids = [row[0] for row in self.connection.execute("SELECT DISTINCT user_id FROM messages")]
+                for user_id in set(user_ids) | set(data):
+                    val = data.setdefault(user_id, {})
+                    history = self._load_messages(user_id, val.get("conversation_default"))
+                    if history:
+                        val["conversation_histories"] = history
+            else:
+                rows = self.connection.execute("SELECT user_id, pos, role, content FROM messages ORDER BY user_id, pos")
+                for user_id, pos, role, content in rows:
+                    history = data.setdefault(user_id, {}).setdefault("conversation_histories", [])
+                    history.append({"role": role, "content": content})
+                    self._positions.setdefault(user_id, []).append(pos)
+            for user_id, val in data.items():
+                self._messages[user_id] = list(val.get("conversation_histories", []))
+        obj.init(data)
+
+    def load_params(self, user_id: str, name: str, obj_default: Any) -> Optional[Any]:
+        if name != "params":
+            return super().load_params(user_id, name, obj_default)
+        with self._lock:
+            row = self.connection.execute("SELECT data FROM params WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                return None
+            self._written[("params", user_id)] = row[0]
+        obj_new = copy.deepcopy(obj_default)
+        obj_new.init(self._loads(row[0]))
+        return obj_new
+
+    def load_params_tuple(self, user_id: str, names: tuple, tuple_default: tuple) -> Optional[tuple]:
+        with self._lock:
+            rows = self.connection.execute("SELECT slot, data FROM speech WHERE user_id = ?", (user_id,)).fetchall()
+            for slot, data in rows:
+                self._written[("speech", user_id, slot)] = data
+        if not rows:
+            return None
+        tuple_new = copy.deepcopy(tuple_default)
+        for slot, data in rows:
+            if slot < len(tuple_new):
+                tuple_new[slot].init(self._loads(data))
+        return tuple_new
+
+    def load_object(self, user_id: str, name: str, obj: Any) -> None:
+        val = {}
+        with self._lock:
+            row = self.connection.execute("SELECT system, model FROM dialogue WHERE user_id = ?", (user_id,)).fetchone()
+            if row is not None:
+                system, model = row
+                self._written[("dialogue", user_id)] = self._dumps(row)
+                if system:
+                    val["conversation_default"] = self._loads(system)
+                if model:
+                    val["user_model"] = model
+            history = self._load_messages(user_id, val.get("conversation_default"))
+            if history:
+                val["conversation_histories"] = history
+            self._messages[user_id] = list(val.get("conversation_histories", []))
+        if val:
+            obj.init({user_id: val})
+
+    # Забыть служебные данные выгруженного из памяти пользователя
+    def unload_user(self, user_id: str) -> None:
+        with self._lock:
+            self._messages.pop(user_id, None)
+            self._positions.pop(user_id, None)
+            self._written.pop(("params", user_id), None)
+            self._written.pop(("dialogue", user_id), None)
+            for slot in range(len(self.speech_names)):
+                self._written.pop(("speech", user_id, slot), None)
+
+    def save_external(
+        self, users_params: dict, users_speech: dict, dialogue: Any, user_ids: Optional[set] = None
+    ) -> int:
+        with self._transaction():
+            start = self._bytes_written
+            self.set_params("params", self._filter_users(users_params, user_ids))
+            self.set_params_tuple(self.speech_names, self._filter_users(users_speech, user_ids))
+            self.set_object("dialogue", dialogue, user_ids)
+            return self._bytes_written - start
+
+
+# Создаёт хранилище пользователей по расширению файла
+def create_user_storage(
+    file_path: str,
+    json_path: str = "users.json",
+    history_log: Optional[HistoryLog] = None,
+    history_last: Optional[int] = None,
+) -> UserStorage:
+    if file_path.endswith((".db", ".sqlite", ".sqlite3")):
+        return SQLiteUserStorage(file_path, json_path, history_log, history_last)
+    return UserStorage(file_path)
 
 
 # Example usage:
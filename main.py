@@ -1,16 +1,34 @@
-from collections import defaultdict
-from datetime import datetime
-from io import BytesIO
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import wraps
 import logging
+import signal
+import sys
+import threading
 from typing import Optional
 
-from telebot.types import BotCommand, ReplyKeyboardMarkup
-
-from lib.bot_params import BotAIModel, BotAnswer, BotMode, BotParams, BotState, BotTypeTranslate, get_class_dict
+from telebot.apihelper import ApiTelegramException
+from telebot.types import BotCommand, InputMediaPhoto, ReplyKeyboardMarkup
+
+from lib.aio import aio_loop
+from lib.bot_params import (
+    BotAIModel,
+    BotAnswer,
+    BotImageQuality,
+    BotImageSize,
+    BotMode,
+    BotParams,
+    BotState,
+    BotTypeTranslate,
+    get_model_budgets,
+)
 from lib.config import Config
 from lib.errors import EmptyContent, UnableDetectLanguage, UnidentifiedMode
 from lib.helpers import (
+    FileChunks,
     StateHandlerDecorator,
+    StreamMessage,
     admin_required,
     bot,
     check_message,
@@ -18,42 +36,152 @@ from lib.helpers import (
     check_user_access,
     command_with_timeout,
     cut_long_message,
+    dispatcher,
     get_alternative_value,
     get_lang2,
     hide_markup,
     is_message_chain,
     parse_args,
     send_message_admin,
+    send_voice_cached,
+    transcriptions,
     user_storage,
+    voice_file_ids,
 )
-from lib.openai import DialogueAI
-from lib.speech import Speech, SpeechLang, SpeechVoice
-from lib.translate import Translate
+from lib.metrics import register_cache, stage_seconds, start_metrics_server
+from lib.openai import DialogueAI, image_downloader, image_executor
+from lib.persistence import AutoSaver, LazyDict
+from lib.speech import Speech, SpeechLang, SpeechVoice, audio_cache, recognize_fanout, speech_models
+from lib.translate import Translate, language_detector, translation_cache
+from lib.users import SQLiteUserStorage
 
 
 ENUM_NEXT = ("Далее>>", "next")
 SPEECH_MENU = (SpeechLang.AUTO, SpeechLang.RU, SpeechLang.US, ENUM_NEXT[0])
+IMAGE_COUNT_MENU = ("1", "2", "3", "4")
+# Меню с пунктом «Далее» строятся один раз, меню перечислений не изменяются
+LANG_NEXT_MENU = SpeechLang.get_menu(capitalize=False).extend({ENUM_NEXT[0]: ENUM_NEXT[0]})
+VOICE_NEXT_MENU = SpeechVoice.get_menu().extend({ENUM_NEXT[0]: ENUM_NEXT[0]})
+TYPE_TRANSLATE_NEXT_MENU = BotTypeTranslate.get_menu().extend({ENUM_NEXT[0]: ENUM_NEXT})
 
 logger = logging.getLogger(__name__)
 
-dialogue = DialogueAI(Config.OPENAI_MODEL)
-users_params = defaultdict(lambda: BotParams())
-users_speech = defaultdict(lambda: (Speech("marina", "auto"), Speech("john", "en-US")))
+dialogue = DialogueAI(Config.OPENAI_MODEL, {**get_model_budgets(), **Config.HISTORY_TOKEN_BUDGETS})
+autosaver = AutoSaver(lambda user_ids: user_storage_save(user_ids), Config.AUTOSAVE_INTERVAL)
+# Состояние пользователя загружается из хранилища при первом обращении
+users_params = LazyDict(lambda: BotParams(), autosaver, lambda user_id: user_params_load(user_id))
+users_speech = LazyDict(
+    lambda: (Speech("marina", "auto"), Speech("john", "en-US")), autosaver, lambda user_id: user_speech_load(user_id)
+)
 users_trans = defaultdict(lambda: Translate())
+# Число выполняющихся обработчиков каждого пользователя: такие пользователи не выгружаются
+users_busy = Counter()
+users_busy_lock = threading.Lock()
 state_handler = StateHandlerDecorator("state_handler")
 mode_handler = StateHandlerDecorator("mode_handler")
 
+# Показатели кэшей для экспорта метрик
+register_cache("language_detector", language_detector.get_stats)
+register_cache("translation", translation_cache.get_stats)
+register_cache("audio", audio_cache.get_stats)
+register_cache("voice_file_ids", voice_file_ids.get_stats)
+register_cache("transcriptions", transcriptions.get_stats)
+
+
+def user_storage_save(user_ids: Optional[set] = None) -> int:
+    return user_storage.save_external(
+        users_params.snapshot(user_ids), users_speech.snapshot(user_ids), dialogue, user_ids
+    )
+
+
+# Пока выполняется обработчик пользователя, пользователь не выгружается
+@contextmanager
+def user_busy(user_id: str):
+    with users_busy_lock:
+        users_busy[user_id] += 1
+    try:
+        yield
+    finally:
+        with users_busy_lock:
+            users_busy[user_id] -= 1
+            if not users_busy[user_id]:
+                del users_busy[user_id]
+
+
+# Обработчик читает состояние пользователя (например, клавиатуру ответа): выгрузка не должна
+# совпасть с его загрузкой
+def uses_user_state(func):
+    @wraps(func)
+    def wrapper(message, *args, **kwargs):
+        with user_busy(str(message.chat.id)):
+            return func(message, *args, **kwargs)
+
+    return wrapper
+
+
+# Обработчик меняет состояние пользователя: после него пользователь сохраняется при автосохранении
+def changes_user_state(func):
+    @wraps(func)
+    def wrapper(message, *args, **kwargs):
+        user_id = str(message.chat.id)
+        with user_busy(user_id):
+            try:
+                return func(message, *args, **kwargs)
+            finally:
+                autosaver.mark_dirty(user_id)
+
+    return wrapper
+
 
-def user_storage_save():
-    user_storage.save_external(users_params, users_speech, dialogue)
+# Вместе с параметрами пользователя загружается и его диалог
+def user_params_load(user_id: str) -> Optional[BotParams]:
+    user_storage.load_object(user_id, "dialogue", dialogue)
+    return user_storage.load_params(user_id, "params", BotParams())
 
 
-def user_storage_load():
-    users_params.update(user_storage.get_params("params", BotParams()))
-    users_speech.update(
-        user_storage.get_params_tuple(("speech_1", "speech_2"), (Speech("marina", "auto"), Speech("john", "en-US")))
+def user_speech_load(user_id: str) -> Optional[tuple]:
+    return user_storage.load_params_tuple(
+        user_id, ("speech_1", "speech_2"), (Speech("marina", "auto"), Speech("john", "en-US"))
     )
-    user_storage.get_object("dialogue", dialogue)
+
+
+# Время последней активности: последнее сообщение или загрузка состояния в память
+def get_last_activity(user_id: str, params: BotParams) -> datetime:
+    loaded_at = users_params.loaded_at.get(user_id, datetime.min)
+    return max(params.data.get("last_time") or loaded_at, loaded_at)
+
+
+# Выгрузка неактивных пользователей: изменения сохраняются, затем состояние удаляется из памяти.
+# Пользователь остаётся в памяти, если после сохранения появились его задачи или изменения
+def evict_idle_users() -> int:
+    deadline = datetime.now() - timedelta(seconds=Config.USER_IDLE_TIMEOUT)
+    user_ids = {
+        user_id
+        for user_id, params in list(users_params.items())
+        if get_last_activity(user_id, params) < deadline and not dispatcher.is_active(user_id)
+    }
+    if not user_ids:
+        return 0
+    autosaver.flush(user_ids=user_ids)
+    evicted = 0
+    for user_id in user_ids:
+        with users_busy_lock:
+            if users_busy[user_id] or dispatcher.is_active(user_id) or autosaver.is_dirty(user_id):
+                continue
+            evict_user(user_id)
+        evicted += 1
+    logger.info("Evicted idle users: %s", evicted)
+    return evicted
+
+
+def evict_user(user_id: str):
+    users_params.pop(user_id, None)
+    users_speech.pop(user_id, None)
+    users_trans.pop(user_id, None)
+    dialogue.unload_user(user_id)
+    # Хранилище в JSON держит всех пользователей для перезаписи файла, выгружает только SQLite
+    if isinstance(user_storage, SQLiteUserStorage):
+        user_storage.unload_user(user_id)
 
 
 def get_markup_message(user_id: str):
@@ -70,15 +198,15 @@ def get_markup_message(user_id: str):
 def check_answer_settings(user_id: str, user_input: str) -> bool:
     params = users_params[user_id]
     if params.mode == BotMode.TRANSLATE and params.type_translate == BotTypeTranslate.MANUAL:
-        user_input = user_input.strip()
-        menu = get_class_dict(SpeechLang, capitalize=False)
-        if user_input in menu:
-            params.lang = menu[user_input]
+        lang = SpeechLang.get_menu(capitalize=False).find(user_input)
+        if lang is not None:
+            params.lang = lang
             return True
     return False
 
 
 @bot.message_handler(commands=["start"])
+@changes_user_state
 def send_welcome(message):
     user_id = str(message.chat.id)
     dialogue.system(user_id)
@@ -98,6 +226,7 @@ def send_welcome(message):
 
 
 @bot.message_handler(commands=["users"])
+@uses_user_state
 @admin_required
 def send_users(message):
     user_id = str(message.chat.id)
@@ -106,6 +235,7 @@ def send_users(message):
 
 
 @bot.message_handler(commands=["allow_access"])
+@uses_user_state
 @admin_required
 @parse_args(r"/allow_access (\d+)")
 def send_allow_access(message, from_user_id):
@@ -114,6 +244,7 @@ def send_allow_access(message, from_user_id):
 
 
 @bot.message_handler(commands=["ban_access"])
+@uses_user_state
 @admin_required
 @parse_args(r"/ban_access (\d+)")
 def send_ban_access(message, from_user_id):
@@ -122,16 +253,47 @@ def send_ban_access(message, from_user_id):
 
 
 @bot.message_handler(commands=["save"])
+@uses_user_state
 @admin_required
 def send_save(message):
     user_id = str(message.chat.id)
-    user_storage_save()
+    autosaver.flush(full=True)
     msg = "Данные всех пользователей сохранены."
     logger.info(msg)
     bot.send_message(user_id, msg, reply_markup=get_markup_message(user_id))
 
 
+@bot.message_handler(commands=["stats"])
+@uses_user_state
+@admin_required
+def send_stats(message):
+    user_id = str(message.chat.id)
+    msg = [
+        f"Пользователей в памяти: {len(users_params)}",
+        "Диспетчер:",
+        dispatcher.to_str(),
+        "Автосохранение:",
+        autosaver.to_str(),
+        "Определение языка:",
+        language_detector.to_str(),
+        "Кэш переводов:",
+        translation_cache.to_str(),
+        "Кэш синтеза речи:",
+        audio_cache.to_str(),
+        "Кэш file_id голосовых:",
+        voice_file_ids.to_str(),
+        "Кэш распознавания голосовых:",
+        transcriptions.to_str(),
+        "Загрузка изображений:",
+        image_downloader.to_str(),
+        "Модели SpeechKit:",
+        speech_models.to_str(),
+    ]
+    bot.send_message(user_id, "\n".join(msg), reply_markup=get_markup_message(user_id))
+
+
 @bot.message_handler(commands=["clear"])
+@changes_user_state
 def send_clear(message):
     user_id = str(message.chat.id)
     params = users_params[user_id]
@@ -141,6 +303,7 @@ def send_clear(message):
 
 
 @bot.message_handler(commands=["system"])
+@changes_user_state
 def send_system(message):
     user_id = str(message.chat.id)
     params = users_params[user_id]
@@ -175,6 +338,7 @@ def handle_system_step2(user_id: str, user_input: str) -> Optional[bool]:
 
 
 @bot.message_handler(commands=["lang"])
+@changes_user_state
 def send_lang(message):
     user_id = str(message.chat.id)
     params = users_params[user_id]
@@ -194,12 +358,11 @@ def send_lang(message):
 def choice_recognition(user_id: str, user_input: str, step: int) -> Optional[bool]:
     params = users_params[user_id]
     speech = users_speech[user_id][step - 1]
-    menu = get_class_dict(SpeechLang, capitalize=False)
-    menu[ENUM_NEXT[0]] = ENUM_NEXT[0]
     msg_error = "Нет такого языка, попробуйте ещё..."
-    if check_message(bot, user_id, user_input, list(menu.keys()), is_markup=SPEECH_MENU, msg_error=msg_error):
-        if user_input != ENUM_NEXT[0]:
-            speech.set_recognition(user_input)
+    if check_message(bot, user_id, user_input, LANG_NEXT_MENU, is_markup=SPEECH_MENU, msg_error=msg_error):
+        lang = LANG_NEXT_MENU.find(user_input)
+        if lang != ENUM_NEXT[0]:
+            speech.set_recognition(lang)
             bot.send_message(user_id, "Язык сохранил!", reply_markup=hide_markup)
         markup = ReplyKeyboardMarkup(one_time_keyboard=True)
         markup.add(ENUM_NEXT[0])
@@ -234,11 +397,10 @@ def handle_recognition2(user_id: str, user_input: str) -> Optional[bool]:
 @state_handler.add_handler(BotState.RECOGNITION_STEP3)
 def handle_recognition3(user_id: str, user_input: str) -> Optional[bool]:
     params = users_params[user_id]
-    menu = get_class_dict(BotTypeTranslate)
-    menu[ENUM_NEXT[0]] = ENUM_NEXT
-    if check_message(bot, user_id, user_input, list(menu.keys()), is_markup=False):
-        if user_input != ENUM_NEXT[0]:
-            params.type_translate = menu[user_input]
+    if check_message(bot, user_id, user_input, TYPE_TRANSLATE_NEXT_MENU, is_markup=False):
+        type_translate = TYPE_TRANSLATE_NEXT_MENU.find(user_input)
+        if type_translate != ENUM_NEXT:
+            params.type_translate = type_translate
             if params.type_translate == BotTypeTranslate.AUTO:
                 params.lang = SpeechLang.AUTO
             bot.send_message(user_id, "Тип перевода сохранил!", reply_markup=get_markup_message(user_id))
@@ -250,12 +412,11 @@ def handle_recognition3(user_id: str, user_input: str) -> Optional[bool]:
 def choice_voice(user_id: str, user_input: str, step: int) -> Optional[bool]:
     params = users_params[user_id]
     speech = users_speech[user_id][step - 1]
-    menu = get_class_dict(SpeechVoice)
-    menu[ENUM_NEXT[0]] = ENUM_NEXT[0]
     msg_error = "Нет такого голоса, попробуйте ещё..."
-    if check_message(bot, user_id, user_input, list(menu.keys()), is_markup=False, msg_error=msg_error):
-        if user_input != ENUM_NEXT[0]:
-            speech.set_synthesis(user_input)
+    if check_message(bot, user_id, user_input, VOICE_NEXT_MENU, is_markup=False, msg_error=msg_error):
+        voice = VOICE_NEXT_MENU.find(user_input)
+        if voice != ENUM_NEXT[0]:
+            speech.set_synthesis(voice)
             bot.send_message(user_id, "Голос сохранил!", reply_markup=hide_markup)
         if step == 1:
             speech = users_speech[user_id][step]
@@ -265,11 +426,8 @@ def choice_voice(user_id: str, user_input: str, step: int) -> Optional[bool]:
             params.state = BotState.RECOGNITION_STEP2
             return False
         elif step == 2:
-            menu = get_class_dict(BotTypeTranslate)
-            menu[ENUM_NEXT[0]] = ENUM_NEXT
-            markup_menu = list(menu.keys())
             markup = ReplyKeyboardMarkup(one_time_keyboard=True)
-            markup.add(*markup_menu)
+            markup.add(*TYPE_TRANSLATE_NEXT_MENU)
             bot.send_message(
                 user_id, f"Тип перевода: {params.type_translate[0]}. Выберите тип перевода.", reply_markup=markup
             )
@@ -290,10 +448,11 @@ def handle_voice2(user_id: str, user_input: str) -> Optional[bool]:
 
 
 @bot.message_handler(commands=["answer"])
+@changes_user_state
 def send_answer(message):
     user_id = str(message.chat.id)
     params = users_params[user_id]
-    answers = list(get_class_dict(BotAnswer).keys())
+    answers = list(BotAnswer.get_menu())
     markup = ReplyKeyboardMarkup(one_time_keyboard=True)
     markup.add(*answers)
     bot.send_message(
@@ -305,9 +464,9 @@ def send_answer(message):
 @state_handler.add_handler(BotState.ANSWER)
 def handle_answer(user_id: str, user_input: str) -> Optional[bool]:
     params = users_params[user_id]
-    menu = get_class_dict(BotAnswer)
-    if check_message(bot, user_id, user_input, list(menu.keys())):
-        params.answer = menu[user_input]
+    menu = BotAnswer.get_menu()
+    if check_message(bot, user_id, user_input, menu):
+        params.answer = menu.find(user_input)
         bot.send_message(user_id, "Формат ответа сохранил!", reply_markup=get_markup_message(user_id))
         return True
     else:
@@ -315,12 +474,12 @@ def handle_answer(user_id: str, user_input: str) -> Optional[bool]:
 
 
 @bot.message_handler(commands=["model"])
+@changes_user_state
 def send_model(message):
     user_id = str(message.chat.id)
     params = users_params[user_id]
-    ai_models = get_class_dict(BotAIModel)
     markup = ReplyKeyboardMarkup(one_time_keyboard=True)
-    markup.add(*list(ai_models.keys()))
+    markup.add(*BotAIModel.get_menu())
     model = dialogue.get_model(user_id)
     bot.send_message(user_id, f"Сейчас используется модель: {model}. Выберите модель ИИ.", reply_markup=markup)
     params.state = BotState.MODEL
@@ -329,9 +488,9 @@ def send_model(message):
 @state_handler.add_handler(BotState.MODEL)
 def handle_model(user_id: str, user_input: str) -> Optional[bool]:
     params = users_params[user_id]
-    menu = get_class_dict(BotAIModel)
-    if check_message(bot, user_id, user_input, list(menu.keys())):
-        params.model = menu[user_input]
+    menu = BotAIModel.get_menu()
+    if check_message(bot, user_id, user_input, menu):
+        params.model = menu.find(user_input)
         dialogue.user_model[user_id] = params.model[1]
         bot.send_message(user_id, "Модель ИИ изменил!", reply_markup=get_markup_message(user_id))
         return True
@@ -340,12 +499,12 @@ def handle_model(user_id: str, user_input: str) -> Optional[bool]:
 
 
 @bot.message_handler(commands=["mode"])
+@changes_user_state
 def send_mode(message):
     user_id = str(message.chat.id)
     params = users_params[user_id]
-    menu = get_class_dict(BotMode)
     markup = ReplyKeyboardMarkup(one_time_keyboard=True)
-    markup.add(*list(menu.keys()))
+    markup.add(*BotMode.get_menu())
     bot.send_message(user_id, f"Сейчас: {params.mode[0]}. Выберите режим функционирования бота.", reply_markup=markup)
     params.state = BotState.MODE
 
@@ -353,30 +512,94 @@ def send_mode(message):
 @state_handler.add_handler(BotState.MODE)
 def handle_mode(user_id: str, user_input: str) -> Optional[bool]:
     params = users_params[user_id]
-    menu = get_class_dict(BotMode)
-    if check_message(bot, user_id, user_input, list(menu.keys())):
-        params.mode = menu[user_input]
+    menu = BotMode.get_menu()
+    if check_message(bot, user_id, user_input, menu):
+        params.mode = menu.find(user_input)
         bot.send_message(user_id, "Режим изменил!", reply_markup=get_markup_message(user_id))
         return True
     else:
         return False
 
 
+@bot.message_handler(commands=["image"])
+@changes_user_state
+def send_image(message):
+    user_id = str(message.chat.id)
+    params = users_params[user_id]
+    markup = ReplyKeyboardMarkup(one_time_keyboard=True)
+    markup.add(*BotImageSize.get_menu())
+    size = f"{params.image_size[0]} {params.image_size[1]}"
+    bot.send_message(user_id, f"Размер: {size}. Выберите размер изображения.", reply_markup=markup)
+    params.state = BotState.IMAGE
+
+
+@state_handler.add_handler(BotState.IMAGE)
+def handle_image(user_id: str, user_input: str) -> Optional[bool]:
+    params = users_params[user_id]
+    menu = BotImageSize.get_menu()
+    if check_message(bot, user_id, user_input, menu):
+        params.image_size = menu.find(user_input)
+        markup = ReplyKeyboardMarkup(one_time_keyboard=True)
+        markup.add(*BotImageQuality.get_menu())
+        bot.send_message(
+            user_id, f"Качество: {params.image_quality[0]}. Выберите качество изображения.", reply_markup=markup
+        )
+        params.state = BotState.IMAGE_STEP2
+    return False
+
+
+@state_handler.add_handler(BotState.IMAGE_STEP2)
+def handle_image2(user_id: str, user_input: str) -> Optional[bool]:
+    params = users_params[user_id]
+    menu = BotImageQuality.get_menu()
+    if check_message(bot, user_id, user_input, menu):
+        params.image_quality = menu.find(user_input)
+        markup = ReplyKeyboardMarkup(one_time_keyboard=True)
+        markup.add(*IMAGE_COUNT_MENU)
+        bot.send_message(
+            user_id, f"Количество: {params.image_count}. Сколько изображений генерировать?", reply_markup=markup
+        )
+        params.state = BotState.IMAGE_STEP3
+    return False
+
+
+@state_handler.add_handler(BotState.IMAGE_STEP3)
+def handle_image3(user_id: str, user_input: str) -> Optional[bool]:
+    params = users_params[user_id]
+    if check_message(bot, user_id, user_input, list(IMAGE_COUNT_MENU)):
+        params.image_count = int(user_input.strip())
+        bot.send_message(user_id, "Настройки изображений сохранил!", reply_markup=get_markup_message(user_id))
+        return True
+    else:
+        return False
+
+
 @mode_handler.add_handler(BotMode.AI)
-def handle_mode_ai(user_id: str, user_input: str) -> (str, Optional[BytesIO]):
+def handle_mode_ai(user_id: str, user_input: str) -> (str, Optional[list], bool):
     params = users_params[user_id]
-    bot.send_message(user_id, f"Ваш запрос отправлен для генерации в {params.model[0]}", reply_markup=hide_markup)
-    response_content, image_bytes = dialogue.generate(user_id, user_input)
-    return response_content, image_bytes
+    message = bot.send_message(
+        user_id, f"Ваш запрос отправлен для генерации в {params.model[0]}", reply_markup=hide_markup
+    )
+    is_text = params.answer in (BotAnswer.TEXT, BotAnswer.ALL)
+    if Config.OPENAI_STREAM and is_text and not dialogue.is_image_model(user_id):
+        stream_message = StreamMessage(bot, user_id, message, interval=Config.STREAM_EDIT_INTERVAL)
+        for delta in dialogue.generate_stream(user_id, user_input):
+            if dispatcher.is_cancelled():
+                break
+            stream_message.add(delta)
+        stream_message.finish()
+        return stream_message.content, None, True
+    response_content, images = dialogue.generate(user_id, user_input, params.get_image_options())
+    return response_content, images, False
 
 
 @mode_handler.add_handler(BotMode.ECHO)
-def handle_mode_echo(user_id: str, user_input: str) -> (str, Optional[BytesIO]):
-    return user_input, None
+def handle_mode_echo(user_id: str, user_input: str) -> (str, Optional[list], bool):
+    return user_input, None, False
 
 
 @mode_handler.add_handler(BotMode.TRANSLATE)
-def handle_mode_translate(user_id: str, user_input: str) -> (str, Optional[BytesIO]):
+def handle_mode_translate(user_id: str, user_input: str) -> (str, Optional[list], bool):
     params = users_params[user_id]
     trans = users_trans[user_id]
     if params.lang == SpeechLang.AUTO:
@@ -392,12 +615,12 @@ def handle_mode_translate(user_id: str, user_input: str) -> (str, Optional[Bytes
         lang_to = langs_map[lang_from] if lang_from in langs_map else "ru"
     else:
         lang_to = speech_to.lang2
-    response_content = trans.translate(user_input, lang_to, lang_from)
-    return response_content, None
+    response_content = trans.translate_paragraphs(user_input, lang_to, lang_from)
+    return response_content, None, False
 
 
 @mode_handler.add_handler(None)
-def handle_mode_other(user_id: str, user_input: str) -> (str, Optional[BytesIO]):
+def handle_mode_other(user_id: str, user_input: str) -> (str, Optional[list], bool):
     raise UnidentifiedMode()
 
 
@@ -407,15 +630,16 @@ def handle_output_message(user_id: str, user_input: str) -> Optional[bool]:
     trans = users_trans[user_id]
 
     if check_user_access(user_id):
-        response_content, image_bytes = mode_handler.handle(params.mode, user_id, user_input)
+        with stage_seconds.time("mode_handler"):
+            response_content, images, is_sent = mode_handler.handle(params.mode, user_id, user_input)
     else:
         msg = "Число генераций для вас ограничено администратором!"
         logger.warning("User: %s, Message: %s", user_id, msg)
         bot.send_message(user_id, msg, reply_markup=get_markup_message(user_id))
         return None
 
-    if image_bytes:
-        bot.send_photo(user_id, image_bytes)
+    if images:
+        send_images(user_id, images)
     if not response_content:
         raise EmptyContent()
 
@@ -428,13 +652,56 @@ def handle_output_message(user_id: str, user_input: str) -> Optional[bool]:
         if lang_from is None:
             raise UnableDetectLanguage()
         speech = Speech.choce_from_lang(users_speech[user_id], lang_from)
-        audio_stream = speech.synthesize(response_content)
-        bot.send_voice(user_id, audio_stream)
-    if params.answer in (BotAnswer.TEXT, BotAnswer.ALL):
+        if Config.SPEECH_DELIVERY == "stream":
+            for audio_stream in speech.synthesize_chunks(response_content):
+                params.data["file_id"] = send_voice_cached(user_id, audio_stream)
+        else:
+            audio_stream = speech.synthesize(response_content)
+            params.data["file_id"] = send_voice_cached(user_id, audio_stream)
+    if params.answer in (BotAnswer.TEXT, BotAnswer.ALL) and not is_sent:
         bot.send_message(user_id, response_content, parse_mode="Markdown", reply_markup=get_markup_message(user_id))
     return None
 
 
+# Отправка изображений: по ссылке Telegram скачивает их сам, при ошибке изображения загружаются через бота.
+# Несколько изображений отправляются одним альбомом
+def send_images(user_id: str, images: list):
+    def _send(items: list):
+        if len(items) == 1:
+            bot.send_photo(user_id, items[0])
+        else:
+            bot.send_media_group(user_id, [InputMediaPhoto(item) for item in items])
+
+    try:
+        _send(images)
+    except ApiTelegramException as ex:
+        if not isinstance(images[0], str):
+            raise
+        logger.warning("User: %s, Send photo by URL error: %s", user_id, ex)
+        _send(list(image_executor.map(image_downloader.get, images)))
+
+
+# Распознавание длинного голосового сообщения по частям: распознанный текст показывается по мере готовности.
+# Возвращает текст и признак того, что распознана вся запись, а не прервана по таймауту
+def recognize_voice_stream(user_id: str, speech: Speech, file_path: str) -> (str, bool):
+    stream_message = StreamMessage(bot, user_id, interval=Config.STREAM_EDIT_INTERVAL)
+    texts = speech.recognize_stream(FileChunks(file_path), Config.SPEECH_STREAM_WINDOW)
+    is_complete = True
+    # Каждое окно попадает в этап stt через Speech.recognize, здесь замеряется вся запись
+    with stage_seconds.time("stt_stream"):
+        try:
+            for text in texts:
+                if dispatcher.is_cancelled():
+                    is_complete = False
+                    break
+                if text:
+                    stream_message.add(f" {text}" if stream_message.content else text)
+        finally:
+            texts.close()
+    stream_message.finish()
+    return stream_message.content.strip(), is_complete
+
+
 def handle_input_message(message) -> (Optional[str], str):
     user_id = str(message.chat.id)
     params = users_params[user_id]
@@ -442,21 +709,45 @@ def handle_input_message(message) -> (Optional[str], str):
     params.data["last_time"] = message_time
     content_type = message.content_type
     if content_type == "voice":
-        lang = params.lang[0] if params.type_translate == BotTypeTranslate.MANUAL else "auto"
-        speech = Speech.choce_from_lang(users_speech[user_id], lang)
-        if speech is None:
-            speech = users_speech[user_id][0]
-        if lang != speech.lang:
-            speech.set_recognition(lang)
+        is_long = message.voice.duration >= Config.SPEECH_STREAM_MIN_DURATION
+        # Оба распознавателя пользователя работают параллельно, состояние Speech не меняется
+        is_fanout = Config.SPEECH_RECOGNITION_FANOUT and params.type_translate == BotTypeTranslate.AUTO and not is_long
+        if is_fanout:
+            speech = None
+            recognition_lang = "+".join(item.lang for item in users_speech[user_id])
+        else:
+            lang = params.lang[0] if params.type_translate == BotTypeTranslate.MANUAL else "auto"
+            speech = Speech.choce_from_lang(users_speech[user_id], lang)
+            if speech is None:
+                speech = users_speech[user_id][0]
+            if lang != speech.lang:
+                speech.set_recognition(lang)
+            recognition_lang = speech.lang
         params.data["file_id"] = None
-        file_info = bot.get_file(message.voice.file_id)
-        audio_data = bot.download_file(file_info.file_path)
-        user_input = speech.recognize(audio_data).strip()
-        if user_input:
+        # Пересланное голосовое сообщение сохраняет file_unique_id, повторно его не распознаём
+        transcription_key = f"{message.voice.file_unique_id}:{recognition_lang}"
+        user_input = transcriptions.get(transcription_key)
+        is_shown = False
+        if user_input is None:
+            is_complete = True
+            file_info = bot.get_file(message.voice.file_id)
+            if is_long:
+                user_input, is_complete = recognize_voice_stream(user_id, speech, file_info.file_path)
+                is_shown = True
+            elif is_fanout:
+                audio_data = bot.download_file(file_info.file_path)
+                user_input, speech = recognize_fanout(users_speech[user_id], audio_data)
+            else:
+                audio_data = bot.download_file(file_info.file_path)
+                user_input = speech.recognize(audio_data).strip()
+            # Частичный текст прерванного распознавания не кэшируется
+            if user_input and is_complete:
+                transcriptions.set(transcription_key, user_input)
+        if user_input and not is_shown:
             bot.send_message(
                 message.chat.id, user_input, parse_mode="Markdown", reply_markup=get_markup_message(user_id)
             )
-        else:
+        if not user_input:
             bot.send_message(
                 message.chat.id,
                 "Извините, я не смог распознать ваше сообщение.",
@@ -477,6 +768,7 @@ def handle_input_message(message) -> (Optional[str], str):
 
 @bot.message_handler(func=lambda message: True, content_types=["text", "voice"])
 @command_with_timeout(timeout=180)
+@changes_user_state
 def handle_message(message):
     user_id = str(message.chat.id)
     params = users_params[user_id]
@@ -512,8 +804,17 @@ if __name__ == "__main__":
         handlers=[file_handler, stream_handler],
     )
 
-    # Передача параметров
-    user_storage_load()
+    # Периодическое сохранение и выгрузка неактивных пользователей
+    if Config.USER_IDLE_TIMEOUT:
+        autosaver.add_task(evict_idle_users)
+    autosaver.start()
+
+    # Метрики в текстовом формате Prometheus
+    if Config.METRICS_PORT:
+        start_metrics_server(Config.METRICS_PORT, Config.METRICS_HOST)
+
+    # Сохранение изменённых данных при остановке сервиса
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     # Запуск бота
     bot.set_my_commands(
@@ -525,6 +826,13 @@ if __name__ == "__main__":
             BotCommand("answer", "Формат ответа: текст или аудио"),
             BotCommand("model", "Выбор модели ИИ"),
             BotCommand("mode", "Выбор режима: эхобот или ИИ"),
+            BotCommand("image", "Размер, качество и число изображений"),
         ]
     )
-    bot.infinity_polling()
+    try:
+        bot.infinity_polling()
+    finally:
+        autosaver.stop()
+        dispatcher.shutdown()
+        if aio_loop:
+            aio_loop.stop()
@@ -0,0 +1,19 @@
+import pytest
+
+from lib.detect import LanguageDetector, detect_local
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["Which fish shop is cheaper?", "She should check each church in the city.", "Fresh cash flash crash"],
+)
+def test_detect_local_without_hints_defers_to_remote(text):
+    assert detect_local(text) is None
+    detector = LanguageDetector()
+    assert detector.detect(text, (), lambda _: "en") == "en"
+    assert detector.remote_calls == 1
+
+
+def test_detect_local_picks_among_hints():
+    assert detect_local("Which fish shop is cheaper?", ("en", "ru")) == "en"
+    assert detect_local("Где находится ближайший магазин?", ("en", "ru")) == "ru"
@@ -0,0 +1,36 @@
+import threading
+
+from lib.dispatcher import Dispatcher, time_left
+
+
+def test_hung_task_releases_user_queue_on_timeout():
+    dispatcher = Dispatcher(max_workers=2)
+    release = threading.Event()
+    timed_out = threading.Event()
+    next_ran = threading.Event()
+    try:
+        # Задача не проверяет is_cancelled() и висит дольше своего таймаута
+        dispatcher.submit("1", release.wait, (10,), timeout=0.2, on_timeout=timed_out.set)
+        dispatcher.submit("1", next_ran.set)
+        assert timed_out.wait(2)
+        assert next_ran.wait(2)
+        assert dispatcher.get_stats()["abandoned"] == 1
+    finally:
+        release.set()
+        dispatcher.shutdown(wait=True)
+
+
+def test_time_left_follows_task_timeout():
+    dispatcher = Dispatcher(max_workers=1)
+    seen = []
+    done = threading.Event()
+
+    def task():
+        seen.append(time_left(60))
+        done.set()
+
+    dispatcher.submit("1", task, timeout=5)
+    assert done.wait(2)
+    dispatcher.shutdown(wait=True)
+    assert 1 <= seen[0] <= 5
+    assert time_left(60) == 60
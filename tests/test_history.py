@@ -0,0 +1,20 @@
+from lib.history import SUMMARY_PREFIX, HistoryManager
+
+
+def test_oversized_evicted_message_is_summarized_truncated():
+    calls = []
+
+    def summarize(messages: list, model: str) -> str:
+        calls.append(messages)
+        return "summary"
+
+    manager = HistoryManager(default_budget=100, summarize=summarize)
+    previous = {"role": "system", "content": SUMMARY_PREFIX + "earlier"}
+    evicted = [{"role": "user", "content": "a" * 1000}, {"role": "assistant", "content": "b" * 40}]
+    summary = manager.summarize_evicted(previous, evicted, "gpt-4", 100)
+
+    assert summary == {"role": "system", "content": SUMMARY_PREFIX + "summary"}
+    # Каждое удаляемое сообщение попало в резюме, вход каждого вызова не превышает бюджет
+    summarized = [message["content"][:1] for messages in calls for message in messages if message["role"] != "system"]
+    assert summarized == ["a", "b"]
+    assert all(manager.history_tokens(messages, "gpt-4") <= 100 for messages in calls)
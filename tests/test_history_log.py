@@ -0,0 +1,35 @@
+import os
+
+from lib.history import SUMMARY_PREFIX
+from lib.history_log import HistoryLog
+from lib.users import SQLiteUserStorage
+
+
+class Dialogue:
+    def __init__(self, history: list):
+        self.history = history
+
+    def to_dict(self, user_ids=None) -> dict:
+        return {"1": {"conversation_histories": self.history}}
+
+
+def message(idx: int) -> dict:
+    return {"role": "user", "content": f"message {idx} " * 10}
+
+
+def test_trimmed_history_is_appended_as_edit(tmp_path):
+    log = HistoryLog(str(tmp_path / "history"))
+    storage = SQLiteUserStorage(str(tmp_path / "users.db"), history_log=log)
+    system = {"role": "system", "content": "system"}
+    history = [system] + [message(idx) for idx in range(6)]
+    storage.set_object("dialogue", Dialogue(history))
+
+    for turn in range(20):
+        history = history + [message(100 + 2 * turn), message(101 + 2 * turn)]
+        history = [system, {"role": "system", "content": f"{SUMMARY_PREFIX}{turn}"}] + history[-5:]
+        size = os.path.getsize(tmp_path / "history" / "1.log")
+        storage.set_object("dialogue", Dialogue(history))
+        # Дописаны только правка, резюме и новые сообщения, а не вся история
+        assert os.path.getsize(tmp_path / "history" / "1.log") - size < 500
+        assert log.read("1") == history
+        assert log.read("1", 3) == history[-3:]